@@ -1,11 +1,17 @@
 import streamlit as st
 from PIL import Image
 from datetime import time, timedelta
+from os import environ
 
 import special_song_search as sss
 
 
 MAX_RECOMMENDATIONS = 10
+MAX_PER_ARTIST = 2
+
+# Optional app cache warm-up inputs
+POPULAR_QUERIES = environ.get('SSS_POPULAR_QUERIES', '')
+SNAPSHOT_PATH = environ.get('SSS_SNAPSHOT', '')
 
 # Reused strings
 ARTIST = 'artist'
@@ -79,6 +85,7 @@ def main() -> None:
 
     col_1, col_2 = st.columns((2,2))
 
+    catalog_cache = init_catalog_cache()
     sql_session = init_sql_session()
     with sql_session:
 
@@ -89,10 +96,10 @@ def main() -> None:
             st.checkbox('Officially Released Only', False, key='official_only')
 
             # Artist Tags
-            display_tags(sql_session, ARTIST)
+            display_tags(catalog_cache, ARTIST)
 
             # Recording Tags
-            display_tags(sql_session, RECORDING)
+            display_tags(catalog_cache, RECORDING)
 
             # Other recording params
             with st.expander('More'):
@@ -100,7 +107,7 @@ def main() -> None:
                 display_recording_date()
 
             # Submit
-            st.button('Submit', on_click=lambda: get_recommendations(sql_session))
+            st.button('Submit', on_click=lambda: get_recommendations(sql_session, catalog_cache))
 
         with col_2:
             st.header('Recommendations')
@@ -113,15 +120,27 @@ def main() -> None:
     return
 
 @st.cache_resource
-def init_sql_session():
-    _, sql_sessionmaker = sss.database.init_db('main')
-    return sql_sessionmaker()
+def init_sql_sessionmaker():
+    _, sql_sessionmaker = sss.database.init_db('main', profile=sss.database.SERVING)
+    return sql_sessionmaker
 
-@st.cache_data
-def get_tag_options_cached(_session, tag_type):
-    return sss.recommend.get_tag_options(_session, tag_type)
+@st.cache_resource
+def init_sql_session():
+    return init_sql_sessionmaker()()
 
-def get_recommendations(_session):
+@st.cache_resource
+def init_catalog_cache():
+    # Warms up and then refreshes in the background whenever a crawl
+    # changes the catalog, so no request waits on the tag option scans
+    return sss.cache.CatalogCache(
+        init_sql_sessionmaker(),
+        popular_queries=(
+            sss.cache.read_queries(POPULAR_QUERIES) if POPULAR_QUERIES else []
+        ),
+        snapshot_path=SNAPSHOT_PATH
+    ).start()
+
+def get_recommendations(_session, catalog_cache):
 
     def get_tags(tag_type):
         if tag_type == ARTIST:
@@ -171,21 +190,27 @@ def get_recommendations(_session):
 
         return ret
 
-    st.session_state[RECOMMENDATIONS] = \
-        sss.recommend.recommend(
-            _session,
-            artist_tags=get_tags(ARTIST),
-            recording_tags=get_tags(RECORDING),
-            weights = {
-                key: st.session_state[f'{key}_weight'] for key in (
-                ARTIST_TAGS,
-                RECORDING_TAGS
-                ) if f'{key}_weight' in st.session_state
-            },
-            recording_length=get_recording_dict('length'),
-            recording_date=get_recording_dict('date'),
-            randomness = 1.,
-        )
+    query = dict(
+        artist_tags=get_tags(ARTIST),
+        recording_tags=get_tags(RECORDING),
+        weights = {
+            key: st.session_state[f'{key}_weight'] for key in (
+            ARTIST_TAGS,
+            RECORDING_TAGS
+            ) if f'{key}_weight' in st.session_state
+        },
+        recording_length=get_recording_dict('length'),
+        recording_date=get_recording_dict('date'),
+        randomness = 1.,
+        limit=MAX_RECOMMENDATIONS,
+        max_per_artist=MAX_PER_ARTIST,
+    )
+
+    # Popular queries are precomputed by the catalog cache
+    recommendations = catalog_cache.recommendations(query)
+    if recommendations is None:
+        recommendations = sss.recommend.recommend(_session, **query)
+    st.session_state[RECOMMENDATIONS] = recommendations
 
 def display_recommendations():
     recs = st.session_state[RECOMMENDATIONS]
@@ -193,16 +218,9 @@ def display_recommendations():
         st.subheader('No results :disappointed:')
         st.write('Try widening your search')
 
-    recording_mbids = set()
-    for rec in st.session_state[RECOMMENDATIONS]:
-        if len(recording_mbids) == MAX_RECOMMENDATIONS:
-            break
-        if rec['recording']['mbid'] not in recording_mbids:
-            recording_mbids.add(rec['recording']['mbid'])
-        else:
-            continue
+    for n, rec in enumerate(recs, start=1):
         st.divider()
-        st.markdown(f"##### {len(recording_mbids)}. {rec['recording']['title']}")
+        st.markdown(f"##### {n}. {rec['recording']['title']}")
         st.text(f"Score: {rec['score']:.2f}")
         st.text(', '.join([artist['name'] for artist in rec['artists']]))
         st.markdown(f"""
@@ -216,11 +234,11 @@ def increase_tags(tags):
     else:
         st.session_state[tags].append(st.session_state[tags][-1] + 1)
 
-def display_tags(session, tag_type):
+def display_tags(catalog_cache, tag_type):
 
     def display_tag(tag_num, tags_str):
         tag, weight, rm = st.columns((4, 1, 0.5))
-        options = get_tag_options_cached(session, tag_type)
+        options = catalog_cache.tag_options(tag_type)
         # Should be checking if tag_num == st.session_state[tags][0] to display
         # labels for first tag, but is unaligned, so don't display until styled
         label_vis = 'visible' if tag_num == None else 'collapsed'
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Python-side overhead per recommend() call.
+
+Times the phases a call pays before the database does any work: building
+the statement, generating its cache key and compiling it, for a cold call
+(new query shape) and a warm one (shape seen before). End-to-end recommend()
+latency is then measured both ways; cold calls clear the statement cache
+and use an engine without SQLAlchemy's compiled cache.
+
+    python benchmarks/recommend_statement_overhead.py sample.db
+    python benchmarks/recommend_statement_overhead.py sample.db --repeat 500
+"""
+
+
+import statistics
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from special_song_search.database import SERVING, init_db
+from special_song_search.recommend import (
+    recommend,
+    get_tag_options,
+    _recommend_statement,
+    _tag_slots
+)
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('database', type=str, help='SQLite database file')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=200,
+                        help='Calls timed per measurement')
+    parser.add_argument('--tags', dest='n_tags', type=int, default=5,
+                        help='Artist and recording tags per query')
+    args = parser.parse_args()
+
+    database = f'sqlite:///{args.database}'
+    _, Session = init_db(database, profile=SERVING)
+    # No compiled cache, so every execution compiles like a new shape would
+    uncached_engine = create_engine(database, query_cache_size=0)
+    UncachedSession = sessionmaker(bind=uncached_engine)
+
+    with Session() as session:
+        query = {
+            'artist_tags': {
+                tag: 1. for tag in get_tag_options(session, 'artist')[:args.n_tags]
+            },
+            'recording_tags': {
+                tag: 1. for tag in get_tag_options(session, 'recording')[:args.n_tags]
+            },
+            'weights': {'artist_tags': 1., 'recording_tags': 1.},
+            'recording_length': {'recording_length_condition': 'range', 'range': [0, None]},
+            'recording_date': {'recording_date_condition': 'center', 'center': 2000,
+                               'points_per_year': 0.1},
+            'limit': 10,
+            'max_per_artist': 2
+        }
+        shape = dict(
+            artist_tag_slots=_tag_slots(args.n_tags),
+            recording_tag_slots=_tag_slots(args.n_tags),
+            join_artist_tags=True,
+            join_recording_tags=True,
+            length_condition='range',
+            length_max=False,
+            date_condition='center',
+            date_max=False,
+            use_features=False,
+            unique_recordings=True,
+            max_per_artist=True
+        )
+        dialect = session.get_bind().dialect
+
+        def build():
+            return _recommend_statement.__wrapped__(**shape)
+
+        statement = build()
+        phases = {
+            'build (cold)': build,
+            'cache lookup (warm)': lambda: _recommend_statement(**shape),
+            'build + cache key (cold)': lambda: build()._generate_cache_key(),
+            'compile (cold)': lambda: statement.compile(dialect=dialect),
+        }
+        for name, phase in phases.items():
+            report(name, timed(phase, args.repeat))
+
+        report('recommend (warm)', timed(lambda: recommend(session, **query), args.repeat))
+
+    with UncachedSession() as session:
+        def cold_recommend():
+            _recommend_statement.cache_clear()
+            return recommend(session, **query)
+        report('recommend (cold)', timed(cold_recommend, args.repeat))
+
+    return
+
+def timed(function, repeat: int) -> list[float]:
+    """ Seconds taken by each of repeat calls of function, after one warm-up """
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+def report(name: str, times: list[float]) -> None:
+    print(
+        f'{name:<26}'
+        f' median {statistics.median(times) * 1e6:9.1f} us'
+        f'  p90 {statistics.quantiles(times, n=10)[-1] * 1e6:9.1f} us'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+recommend() latency while a crawl-like writer is inserting recordings.
+
+Works on a copy of an SQLite database. Latency is measured with the app's
+SERVING profile and the crawler's INGEST profile, or with neither
+(--no-profile) for comparison.
+
+    python benchmarks/recommend_under_ingest.py sample.db
+    python benchmarks/recommend_under_ingest.py sample.db --no-profile
+"""
+
+
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+from multiprocessing import Event, Process
+
+from sqlalchemy import select, func
+
+from special_song_search.database import (
+    init_db, insert_ignore, SERVING, INGEST
+)
+from special_song_search.features import update_recording_features
+from special_song_search.models import (
+    artist_recording_association,
+    Artist, Recording, RecordingTag
+)
+from special_song_search.recommend import recommend
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('database', type=str, help='SQLite database file to copy')
+    parser.add_argument('--duration', dest='duration', type=float, default=10.,
+                        help='Seconds to measure in each phase')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=100,
+                        help='Recordings per writer commit')
+    parser.add_argument('--no-profile', dest='profile', action='store_false',
+                        default=True, help='Use default SQLite settings')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        shutil.copy(args.database, path)
+        database = f'sqlite:///{path}'
+        # Create the schema before the read-only connections open it
+        init_db(database)
+
+        reader_profile = SERVING if args.profile else ''
+        writer_profile = INGEST if args.profile else ''
+
+        _, Session = init_db(database, profile=reader_profile)
+        with Session() as session:
+            tags = session.execute(
+                select(RecordingTag.tag)
+                .group_by(RecordingTag.tag)
+                .order_by(func.count('*').desc())
+                .limit(20)
+            ).scalars().all()
+            queries = [
+                {
+                    'recording_tags': {tag: 1.0, other_tag: 0.5},
+                    'weights': {'recording_tags': 1.0},
+                    'recording_length': {'recording_length_condition': 'range',
+                                         'range': [0, None]},
+                    'recording_date': {'recording_date_condition': 'range',
+                                       'range': [1900, None]},
+                    'limit': 10
+                }
+                for tag, other_tag in zip(tags, tags[1:] + tags[:1])
+            ]
+
+            idle = measure(session, queries, args.duration)
+
+            stop = Event()
+            writer = Process(
+                target=write_recordings,
+                args=(database, writer_profile, args.batch_size, stop)
+            )
+            writer.start()
+            try:
+                busy = measure(session, queries, args.duration)
+            finally:
+                stop.set()
+                writer.join()
+
+    print(f"profile: {'serving/ingest' if args.profile else 'none'}")
+    for name, latencies in (('idle', idle), ('during ingest', busy)):
+        if not latencies:
+            print(f'{name:>14}: no successful calls')
+            continue
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f'{name:>14}: {len(latencies)} calls, '
+            f'p50 {quantiles[49] * 1_000:.1f} ms, '
+            f'p95 {quantiles[94] * 1_000:.1f} ms, '
+            f'max {max(latencies) * 1_000:.1f} ms'
+        )
+
+    return
+
+def measure(session, queries: list[dict], duration: float) -> list[float]:
+    """ Latencies of recommend() calls cycling through queries for duration """
+    latencies = []
+    end = time.perf_counter() + duration
+    query_n = 0
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        try:
+            recommend(session, **queries[query_n % len(queries)])
+        except Exception as error:
+            session.rollback()
+            print(f'recommend() failed: {error}')
+        else:
+            latencies.append(time.perf_counter() - start)
+        query_n += 1
+    return latencies
+
+def write_recordings(database: str, profile: str, batch_size: int, stop) -> None:
+    """ Insert synthetic recordings in committed batches, like a crawl """
+    _, Session = init_db(database, profile=profile)
+    with Session() as session:
+        artist_mbid = session.execute(select(Artist.mbid).limit(1)).scalar()
+        while not stop.is_set():
+            recording_rows = [
+                {'mbid': str(uuid.uuid4()), 'title': 'Benchmark', 'length': 200_000,
+                 'date': '2000'}
+                for _ in range(batch_size)
+            ]
+            session.execute(insert_ignore(session, Recording.__table__), recording_rows)
+            session.execute(
+                insert_ignore(session, RecordingTag.__table__),
+                [
+                    {'recording_mbid': row['mbid'], 'tag': 'benchmark', 'tag_votes': 1}
+                    for row in recording_rows
+                ]
+            )
+            if artist_mbid is not None:
+                session.execute(
+                    insert_ignore(session, artist_recording_association),
+                    [
+                        {'artist_mbid': artist_mbid, 'recording_mbid': row['mbid']}
+                        for row in recording_rows
+                    ]
+                )
+            update_recording_features(session, [row['mbid'] for row in recording_rows])
+            session.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,47 @@ def _import_recommend():
     from . import recommend
     return recommend
 
+def _import_snapshot():
+    from . import snapshot
+    return snapshot
+
+def _import_shard():
+    from . import shard
+    return shard
+
+def _import_search():
+    from . import search
+    return search
+
+def _import_index():
+    from . import index
+    return index
+
+def _import_ratelimit():
+    from . import ratelimit
+    return ratelimit
+
+def _import_cache():
+    from . import cache
+    return cache
+
+def _import_crawl():
+    from . import crawl
+    return crawl
+
+def _import_features():
+    from . import features
+    return features
+
+ratelimit = _import_ratelimit()
 musicb = _import_musicb()
 models = _import_models()
+features = _import_features()
 database = _import_database()
+search = _import_search()
 recommend = _import_recommend()
+snapshot = _import_snapshot()
+shard = _import_shard()
+index = _import_index()
+cache = _import_cache()
+crawl = _import_crawl()
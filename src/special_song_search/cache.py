@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy.orm import sessionmaker
+
+from special_song_search.database import init_db, catalog_generation, SERVING
+from special_song_search.recommend import recommend, get_tag_options
+from special_song_search.snapshot import load_snapshot, Snapshot
+from special_song_search.index import TagIndex
+
+
+# Seconds between catalog generation checks
+REFRESH_INTERVAL = 60.
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Warm the app caches once and report timings')
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR"
+                             )
+                        )
+    parser.add_argument('--popular-queries', dest='popular_queries', type=str, default='',
+                        help='JSONL file of recommend() keyword arguments to precompute')
+    parser.add_argument('--snapshot', dest='snapshot_path', type=str, default='',
+                        help='Snapshot (or directory of snapshots) to load')
+    parser.add_argument('--index', dest='build_index', action='store_true', default=False,
+                        help='Also build the in-memory TagIndex')
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    _, Session = init_db(args.database, verbose=args.verbose, profile=SERVING)
+    cache = CatalogCache(
+        Session,
+        popular_queries=read_queries(args.popular_queries) if args.popular_queries else [],
+        snapshot_path=args.snapshot_path,
+        build_index=args.build_index
+    )
+    start = time.perf_counter()
+    cache.refresh()
+    entry = cache.entry
+    print(json.dumps({
+        'generation': entry.generation,
+        'artist_tags': len(entry.tag_options['artist']),
+        'recording_tags': len(entry.tag_options['recording']),
+        'popular_queries': len(entry.recommendations),
+        'snapshot': entry.snapshot is not None,
+        'index': entry.index is not None,
+        'seconds': round(time.perf_counter() - start, 3)
+    }))
+
+    return
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    """ Everything derived from one catalog generation """
+    generation: str
+    tag_options: dict[str, list[str]]
+    recommendations: dict[str, list[dict]] = field(default_factory=dict)
+    snapshot: Snapshot | None = None
+    index: TagIndex | None = None
+
+
+class CatalogCache:
+    """
+    Tag options, popular query results and an optional snapshot or TagIndex,
+    rebuilt whenever the catalog generation changes.
+
+    start() warms the cache in a daemon thread, which then polls
+    catalog_generation every interval seconds. A new CacheEntry is built
+    off to the side and swapped in with a single assignment, so readers
+    keep the previous entry until then and never wait on a rebuild, except
+    for the very first one. If that warm-up fails, readers get an empty
+    entry until a later refresh succeeds.
+
+    Popular queries are run with recommend() and their results served by
+    recommendations() until the catalog changes, so they repeat the same
+    random draw in between.
+    """
+
+    def __init__(
+            self,
+            Session: sessionmaker,
+            popular_queries: list[dict] = [],
+            snapshot_path: str = '',
+            build_index: bool = False,
+            interval: float = REFRESH_INTERVAL
+        ):
+        self.Session = Session
+        self.popular_queries = list(popular_queries)
+        self.snapshot_path = snapshot_path
+        self.build_index = build_index
+        self.interval = interval
+        self.entry: CacheEntry | None = None
+        self.errors = 0
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> 'CatalogCache':
+        """ Warm up and keep refreshing in the background """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='catalog-cache', daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def refresh(self) -> bool:
+        """ Rebuild the entry if the catalog changed, returning whether it did """
+        with self.Session() as session:
+            generation = catalog_generation(session)
+            if self.entry is not None and self.entry.generation == generation:
+                return False
+            entry = self._build(session, generation)
+
+        self.entry = entry
+        self._ready.set()
+        return True
+
+    def tag_options(self, tag_type: str) -> list[str]:
+        return self._current().tag_options[tag_type]
+
+    def recommendations(self, query: dict) -> list[dict] | None:
+        """ Precomputed results of a popular query, None if it is not one """
+        return self._current().recommendations.get(query_key(query))
+
+    @property
+    def snapshot(self) -> Snapshot | None:
+        return self._current().snapshot
+
+    @property
+    def index(self) -> TagIndex | None:
+        return self._current().index
+
+    def _current(self) -> CacheEntry:
+        if self._thread is None:
+            if self.entry is None:
+                self.refresh()
+            return self.entry
+
+        self._ready.wait()
+        if self.entry is None:
+            # Warm-up failed; the refresher keeps retrying
+            return CacheEntry(generation='', tag_options={'artist': [], 'recording': []})
+        return self.entry
+
+    def _build(self, session, generation: str) -> CacheEntry:
+        tag_options = {
+            tag_type: get_tag_options(session, tag_type)
+            for tag_type in ('artist', 'recording')
+        }
+
+        # Also pulls the pages popular queries touch into the page cache
+        recommendations = {
+            query_key(query): recommend(session, **query)
+            for query in self.popular_queries
+        }
+
+        return CacheEntry(
+            generation=generation,
+            tag_options=tag_options,
+            recommendations=recommendations,
+            snapshot=load_snapshot(self.snapshot_path) if self.snapshot_path else None,
+            index=TagIndex.from_session(session) if self.build_index else None
+        )
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the previous entry; retry next interval
+                self.errors += 1
+                logger.exception('Catalog cache refresh failed')
+                self._ready.set()
+            if self._stop.wait(self.interval):
+                return
+
+
+def query_key(query: dict) -> str:
+    """ Key of a recommend() query, independent of its argument order """
+    return json.dumps(query, sort_keys=True)
+
+def read_queries(path: str) -> list[dict]:
+    """ recommend() keyword arguments from a JSONL file, ids dropped """
+    with open(path) as queries_file:
+        queries = [json.loads(line) for line in queries_file if line.strip()]
+    for query in queries:
+        query.pop('id', None)
+    return queries
+
+
+if __name__ == '__main__':
+    main()
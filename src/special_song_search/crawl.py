@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+from multiprocessing import Process
+
+from special_song_search import musicb
+from special_song_search.database import init_db, fill_artists_and_recordings, INGEST
+from special_song_search.ratelimit import DEFAULT_PATH
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description=('Crawl several countries in parallel, one process each, '
+                     +'under one MusicBrainz rate limit shared by all of them')
+    )
+    parser.add_argument('n_artists', type=int,
+                        help='Number of artists to add to database per country')
+    parser.add_argument('n_recordings', type=int,
+                        help='Max recordings per artist, -1 to use max given in musicb.py')
+    parser.add_argument('countries', type=str, nargs='+',
+                        help='Countries from which to get artists')
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR - USE WITH CAUTION"
+                             )
+                        )
+    parser.add_argument('--rate-limit-file', dest='rate_limit_file', type=str,
+                        default=DEFAULT_PATH,
+                        help='File holding the rate limit shared by all crawlers')
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    # Create the schema once, before crawlers racing to create it
+    init_db(args.database, verbose=args.verbose, profile=INGEST)
+
+    crawlers = [
+        Process(
+            target=crawl_country,
+            args=(
+                args.database,
+                country_code,
+                args.n_artists,
+                args.n_recordings,
+                args.rate_limit_file,
+                args.verbose
+            ),
+            name=f'crawl-{country_code}'
+        )
+        for country_code in args.countries
+    ]
+    for crawler in crawlers:
+        crawler.start()
+    for crawler in crawlers:
+        crawler.join()
+
+    return
+
+def crawl_country(
+        database: str,
+        country_code: str,
+        n_artists: int,
+        n_recordings: int,
+        rate_limit_file: str = DEFAULT_PATH,
+        verbose: bool = False
+    ) -> None:
+    """ Fill artists and recordings from one country under the shared limit """
+    _, Session = init_db(database, verbose=verbose, profile=INGEST)
+    musicb.connect_to_musicbrainz(verbose=verbose, shared_rate_limit=rate_limit_file)
+
+    with Session() as session:
+        fill_artists_and_recordings(
+            session=session,
+            country_code=country_code,
+            n_artists=n_artists,
+            n_recordings=n_recordings,
+            verbose=verbose
+        )
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -4,25 +4,63 @@
 
 # Standard
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import select
 from sqlalchemy import func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import text
+from sqlalchemy import insert
+from sqlalchemy import update
+from sqlalchemy import Table
+from sqlalchemy import inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.exc import IntegrityError
 from dotenv import load_dotenv
 from os import environ
+from itertools import islice
+from contextlib import contextmanager
+from uuid import uuid4
+from typing import Iterable, Iterator
 
 # Typing
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.sql.dml import Insert
 
 # Custom
 from special_song_search import musicb
+from special_song_search.features import update_recording_features, update_artist_features
+from special_song_search.search import SEARCH_COLUMNS, search_document
 from special_song_search.models import (
     Base,
+    artist_recording_association,
     Artist, ArtistTag,
-    Recording, RecordingTag
+    Recording, RecordingTag,
+    CatalogGeneration
 )
 
 
+# SQLite connection profiles for init_db
+SERVING = 'serving'
+INGEST = 'ingest'
+SQLITE_PRAGMAS = {
+    SERVING: [
+        'journal_mode = WAL',
+        'busy_timeout = 30000',
+        'mmap_size = 1073741824',
+        'cache_size = -262144', # KiB
+        'temp_store = MEMORY',
+        'query_only = ON'
+    ],
+    INGEST: [
+        'journal_mode = WAL',
+        'busy_timeout = 30000',
+        'synchronous = NORMAL',
+        'cache_size = -65536'
+    ]
+}
+
+
 def main() -> None:
     from argparse import ArgumentParser
     parser = ArgumentParser()
@@ -45,7 +83,7 @@ def main() -> None:
     parser.add_argument('-v', dest='verbose', action='store_true', default=False)
     args = parser.parse_args()
 
-    engine, Session = init_db(args.database, verbose=args.verbose)
+    engine, Session = init_db(args.database, verbose=args.verbose, profile=INGEST)
     musicb.connect_to_musicbrainz(verbose=args.verbose)
 
     with Session() as session:
@@ -60,7 +98,18 @@ def main() -> None:
     return
 
 
-def init_db(database: str = '', verbose: bool = False) -> tuple[Engine, sessionmaker]:
+def init_db(
+        database: str = '',
+        verbose: bool = False,
+        profile: str = ''
+    ) -> tuple[Engine, sessionmaker]:
+    """
+    Connect to database, creating the schema unless profile is SERVING.
+
+    profile tunes SQLite connections, see SQLITE_PRAGMAS: SERVING for the
+    app's read-only connections, INGEST for crawlers. Both use WAL so readers
+    are not blocked by a crawl's commits. Other backends ignore it.
+    """
     if database == '':
         database = "sqlite:///test.db"
     if database == 'main':
@@ -70,14 +119,146 @@ def init_db(database: str = '', verbose: bool = False) -> tuple[Engine, sessionm
         print(f'Connecting to {database}')
 
     engine = create_engine(database, future=True)
+    if profile and engine.dialect.name == 'sqlite':
+        pragmas = SQLITE_PRAGMAS[profile]
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(f'PRAGMA {pragma}')
+            cursor.close()
+
     Session = sessionmaker(bind=engine, future=True)
-    Base.metadata.create_all(bind=engine)
+    if profile != SERVING:
+        Base.metadata.create_all(bind=engine)
+        create_catalog_generation(engine)
+        create_search_index(engine)
 
     if verbose:
         print('Connected')
 
     return engine, Session
 
+def create_search_index(engine: Engine) -> None:
+    """
+    Create full-text indexes on recording titles and artist names.
+
+    SQLite gets FTS5 tables holding each row's mbid (unindexed) and a copy
+    of its text, kept in sync by triggers and backfilled when first created.
+    They are keyed on mbid rather than rowid, which VACUUM may renumber for
+    tables with TEXT primary keys. As mbid is not indexed by FTS5, the
+    delete and update triggers scan the whole FTS table for each changed
+    row; ingestion only inserts, so they are for occasional manual edits.
+    PostgreSQL gets GIN indexes on the tsvector expressions used by
+    search.py. Other backends are left without an index, and search.py
+    raises ValueError for them.
+    """
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as connection:
+            for table, columns in SEARCH_COLUMNS.items():
+                exists = connection.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+                    {'name': f'{table}_search'}
+                ).first()
+                if exists:
+                    continue
+                column_list = ', '.join(columns)
+                new_values = ', '.join(f'new.{column}' for column in columns)
+                statements = [
+                    f"CREATE VIRTUAL TABLE {table}_search USING fts5("
+                    f"mbid UNINDEXED, {column_list})",
+                    f"CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO {table}_search(mbid, {column_list}) "
+                    f"VALUES (new.mbid, {new_values}); END",
+                    f"CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table} BEGIN "
+                    f"DELETE FROM {table}_search WHERE mbid = old.mbid; END",
+                    f"CREATE TRIGGER {table}_search_update AFTER UPDATE ON {table} BEGIN "
+                    f"DELETE FROM {table}_search WHERE mbid = old.mbid; "
+                    f"INSERT INTO {table}_search(mbid, {column_list}) "
+                    f"VALUES (new.mbid, {new_values}); END",
+                    f"INSERT INTO {table}_search(mbid, {column_list}) "
+                    f"SELECT mbid, {column_list} FROM {table}"
+                ]
+                for statement in statements:
+                    connection.execute(text(statement))
+
+    elif engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            for table in SEARCH_COLUMNS:
+                connection.execute(text(
+                    f'CREATE INDEX IF NOT EXISTS {table}_search ON {table} '
+                    f'USING gin (({search_document(table)}))'
+                ))
+
+    return
+
+def create_catalog_generation(engine: Engine) -> None:
+    """ Add the catalog_generation row, if missing, with a new catalog_id """
+    try:
+        with engine.begin() as connection:
+            if connection.execute(select(CatalogGeneration.id)).first() is None:
+                connection.execute(
+                    insert(CatalogGeneration),
+                    {'id': 1, 'catalog_id': uuid4().hex, 'generation': 0}
+                )
+    except IntegrityError:
+        # Added by another process's init_db in the meantime
+        pass
+
+
+def catalog_generation(session) -> str:
+    """
+    Identify the current catalog contents by the catalog_generation counter.
+
+    Only writes made through bump_catalog_generation (all of this module's
+    fill functions) change it. Databases created before the table existed,
+    and opened with the SERVING profile which does not create it, are
+    generation '0' like an empty table.
+    """
+    if not inspect(session.connection()).has_table(CatalogGeneration.__tablename__):
+        return '0'
+    row = session.execute(
+        select(CatalogGeneration.catalog_id, CatalogGeneration.generation)
+        .where(CatalogGeneration.id == 1)
+    ).first()
+    if row is None:
+        return '0'
+    return f'{row.catalog_id[:8]}-{row.generation}'
+
+def bump_catalog_generation(session) -> None:
+    """
+    Increment the catalog generation. Call before committing a write.
+
+    The row is added by init_db, so this is a single UPDATE, which
+    concurrent crawlers serialize on.
+    """
+    session.execute(
+        update(CatalogGeneration)
+        .where(CatalogGeneration.id == 1)
+        .values(generation=CatalogGeneration.generation + 1)
+    )
+
+@contextmanager
+def read_transaction(session) -> Iterator[Session]:
+    """
+    Yield a new session on session's engine whose reads all see one state
+    of the database, rolled back on exit.
+
+    pysqlite only opens a transaction before DML, so each of several
+    SELECTs would otherwise see the latest commit, which a concurrent crawl
+    may have made in between. SQLite gets an explicit BEGIN, PostgreSQL a
+    REPEATABLE READ transaction.
+    """
+    engine = session.get_bind()
+    with Session(bind=engine, future=True) as reader:
+        if engine.dialect.name == 'sqlite':
+            reader.execute(text('BEGIN'))
+        elif engine.dialect.name == 'postgresql':
+            reader.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        yield reader
+        reader.rollback()
+
 
 def fill_artists_and_recordings(
         session,
@@ -91,11 +272,11 @@ def fill_artists_and_recordings(
     if verbose:
         print('Filling artists and recordings')
 
-    artists = fill_artists(session, country_code, n_artists, verbose)
-
-    if fill_recordings:
-        for artist in artists:
-            fill_artist_recordings(session, artist, n_recordings, verbose)
+    # Recordings of each page of artists are filled before the next page
+    for artists in fill_artist_batches(session, country_code, n_artists, verbose):
+        if fill_recordings:
+            for artist in artists:
+                fill_artist_recordings(session, artist, n_recordings, verbose)
 
     return
 
@@ -106,6 +287,21 @@ def fill_artists(
         verbose: bool = False
     ) -> list[Artist]:
 
+    return [
+        artist
+        for artists in fill_artist_batches(session, country_code, n_artists, verbose)
+        for artist in artists
+    ]
+
+def fill_artist_batches(
+        session,
+        country_code,
+        n_artists,
+        verbose: bool = False,
+        batch_size: int = musicb.SEARCH_BROWSE_LIMIT
+    ) -> Iterator[list[Artist]]:
+    """ Add artists from country_code, committing and yielding each batch """
+
     if verbose:
         print('Filling artists')
 
@@ -113,112 +309,95 @@ def fill_artists(
         select(func.count('*')).where(Artist.country == country_code)
     ).first()[0]
 
-    artists, artist_tags = zip(
-        *musicb.get_artists_from_country(
-            country_code=country_code,
-            offset=offset,
-            n_artists=n_artists
-        )
+    artists = musicb.iter_artists_from_country(
+        country_code=country_code,
+        offset=offset,
+        n_artists=n_artists
     )
 
-    artist_rows = [
-        Artist(
-            mbid=artist['id'],
-            name=artist.get('name', None),
-            disambiguation=artist.get('disambiguation', None),
-            type=artist.get('type', None),
-            gender=artist.get('gender', None),
-            country=artist.get('country', None),
-            life_span_begin=artist.get('life_span_begin', None),
-            life_span_end=artist.get('life_span_end', None),
-            rating_votes=artist.get('rating_votes', None),
-            rating=artist.get('rating', None)
-        )
-        for artist in artists
-    ]
-
-    artist_tag_rows = [
-        [
-            ArtistTag(
-                artist_mbid=artist_row.mbid,
-                artist=artist_row,
-                tag=tag['name'],
-                tag_votes=tag['count']
-            )
-            for tag in tags
-        ]
-        for artist_row, tags in zip(artist_rows, artist_tags)
-    ]
-
-    session.add_all(artist_rows)
-    for tag_rows in artist_tag_rows:
-        session.add_all(tag_rows)
-    session.commit()
+    # Core executemany inserts; rows are plain dicts, not ORM objects
+    for batch in batched(artists, batch_size):
+        artist_rows, tag_rows = musicb.table_batches(batch, 'artist_mbid')
+        session.execute(insert_ignore(session, Artist.__table__), artist_rows)
+        if tag_rows:
+            session.execute(insert_ignore(session, ArtistTag.__table__), tag_rows)
+        # Artists already stored may have recordings whose features now differ
+        update_artist_features(session, [row['mbid'] for row in artist_rows])
+        bump_catalog_generation(session)
+        session.commit()
+
+        yield session.execute(
+            select(Artist).where(Artist.mbid.in_([row['mbid'] for row in artist_rows]))
+        ).scalars().all()
 
-    return artist_rows
+    return
 
 def fill_artist_recordings(
         session,
         artist: Artist,
         n_recordings: int,
         verbose: bool = False,
+        batch_size: int = musicb.SEARCH_BROWSE_LIMIT
     ) -> None:
 
     if verbose:
         print('Filling recordings')
 
-    recordings, recording_tags = zip(
-        *musicb.get_artist_recordings(
-            artist_mbid=artist.mbid,
-            n_recordings=n_recordings,
-            verbose=verbose
-        )
+    # Stored recordings (e.g. collaborations) only need the artist added,
+    # so their detail lookups are skipped
+    recordings = musicb.iter_artist_recordings(
+        artist_mbid=artist.mbid,
+        n_recordings=n_recordings,
+        verbose=verbose,
+        known_mbids=lambda mbids: known_recording_mbids(session, mbids)
     )
 
-    recording_rows = [
-        Recording(
-            mbid=recording['id'],
-            title=recording.get('title', None),
-            disambiguation=recording.get('disambiguation', None),
-            length=recording.get('length', None),
-            date=recording.get('date', None),
-            rating_votes=recording.get('rating_votes', None),
-            rating=recording.get('rating', None),
-            release_status=recording.get('release_status', None)
-        )
-        for recording in recordings
-    ]
-
-    recording_tag_rows = [
-        [
-            RecordingTag(
-                recording_mbid=recording_row.mbid,
-                recording=recording_row,
-                tag=tag['name'],
-                tag_votes=tag['count']
-            )
-            for tag in tags
+    # At most batch_size API responses are held before being written.
+    # Conflicting rows (e.g. from another crawler) are skipped, not retried
+    for batch in batched(recordings, batch_size):
+        new = [(recording, tags) for recording, tags in batch if tags is not None]
+        recording_rows, tag_rows = musicb.table_batches(new, 'recording_mbid')
+        association_rows = [
+            {'artist_mbid': artist.mbid, 'recording_mbid': recording.mbid}
+            for recording, _ in batch
         ]
-        for recording_row, tags in zip(recording_rows, recording_tags)
-    ]
 
-    # Commits in loop slow, but limiting factor is API rate
-    # Don't want to have to redo valid adds which requires recalling API
-    for recording_row, tag_rows in zip(recording_rows, recording_tag_rows):
-        try:
-            artist.recordings.add(recording_row)
-            session.add_all(tag_rows)
-            session.commit()
-        except IntegrityError:
-            session.rollback()
-            recording = session.execute(
-                select(Recording).where(Recording.mbid == recording_row.mbid)
-            ).scalar()
-            artist.recordings.add(recording)
-            session.commit()
+        if recording_rows:
+            session.execute(insert_ignore(session, Recording.__table__), recording_rows)
+        if tag_rows:
+            session.execute(insert_ignore(session, RecordingTag.__table__), tag_rows)
+        session.execute(
+            insert_ignore(session, artist_recording_association), association_rows
+        )
+        update_recording_features(session, [row['recording_mbid'] for row in association_rows])
+        bump_catalog_generation(session)
+        session.commit()
 
     return
 
+def insert_ignore(session, table: Table) -> Insert:
+    """ INSERT into table that skips rows conflicting with existing keys """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+def known_recording_mbids(session, mbids: list[str]) -> set[str]:
+    """ The subset of mbids already in the recording table """
+    if not mbids:
+        return set()
+    return set(session.execute(
+        select(Recording.mbid).where(Recording.mbid.in_(mbids))
+    ).scalars())
+
+def batched(iterable: Iterable, batch_size: int) -> Iterator[list]:
+    """ Lists of up to batch_size consecutive items of iterable """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
 
 if __name__ == '__main__':
     main()
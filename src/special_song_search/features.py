@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+from sqlalchemy import select
+from sqlalchemy import insert
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import case
+from sqlalchemy import literal
+from sqlalchemy import Float
+from sqlalchemy import Select
+
+from special_song_search.models import (
+    artist_recording_association,
+    ArtistTag,
+    RecordingTag,
+    RecordingFeature
+)
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    from special_song_search.database import init_db
+    parser = ArgumentParser(description='Rebuild the recording_feature table')
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR - USE WITH CAUTION"
+                             )
+                        )
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    _, Session = init_db(args.database, verbose=args.verbose)
+    with Session() as session:
+        rebuild_recording_features(session)
+        session.commit()
+        if args.verbose:
+            n_features = session.execute(
+                select(func.count('*')).select_from(RecordingFeature)
+            ).scalar()
+            print(f'Rebuilt {n_features} recording features')
+
+    return
+
+def rebuild_recording_features(session) -> None:
+    """ Recompute every recording's features. Does not commit. """
+    session.execute(delete(RecordingFeature))
+    _insert_features(session, None)
+
+def update_recording_features(session, recording_mbids: list[str] | Select) -> None:
+    """
+    Recompute the features of recording_mbids, a list or a select of
+    mbids. Does not commit.
+
+    Called after their tags or artists change.
+    """
+    if isinstance(recording_mbids, list) and not recording_mbids:
+        return
+    session.execute(
+        delete(RecordingFeature)
+        .where(RecordingFeature.recording_mbid.in_(recording_mbids))
+    )
+    _insert_features(session, recording_mbids)
+
+def update_artist_features(session, artist_mbids: list[str]) -> None:
+    """
+    Recompute the features of the artists' recordings after their tags
+    change. The recordings are selected in SQL, as prolific artists can
+    have more than a bound-parameter list holds.
+    """
+    if not artist_mbids:
+        return
+    update_recording_features(
+        session,
+        select(artist_recording_association.c.recording_mbid)
+        .where(artist_recording_association.c.artist_mbid.in_(artist_mbids))
+    )
+
+def _insert_features(session, recording_mbids: list[str] | Select | None) -> None:
+    if recording_mbids is None:
+        artist_mbids = None
+    else:
+        artist_mbids = (
+            select(artist_recording_association.c.artist_mbid)
+            .where(artist_recording_association.c.recording_mbid.in_(recording_mbids))
+        )
+
+    recording_weights = _normalized_votes(
+        RecordingTag, RecordingTag.recording_mbid, recording_mbids
+    )
+    recording_features = select(
+        recording_weights.c.owner_mbid,
+        literal('recording'),
+        recording_weights.c.tag,
+        recording_weights.c.weight
+    )
+
+    artist_weights = _normalized_votes(ArtistTag, ArtistTag.artist_mbid, artist_mbids)
+    artist_features = (
+        select(
+            artist_recording_association.c.recording_mbid,
+            literal('artist'),
+            artist_weights.c.tag,
+            func.max(artist_weights.c.weight)
+        )
+        .join(artist_weights,
+            artist_weights.c.owner_mbid == artist_recording_association.c.artist_mbid
+            )
+        .group_by(artist_recording_association.c.recording_mbid, artist_weights.c.tag)
+    )
+    if recording_mbids is not None:
+        artist_features = artist_features.where(
+            artist_recording_association.c.recording_mbid.in_(recording_mbids)
+        )
+
+    columns = ['recording_mbid', 'source', 'tag', 'weight']
+    table = RecordingFeature.__table__
+    session.execute(insert(table).from_select(columns, recording_features))
+    session.execute(insert(table).from_select(columns, artist_features))
+
+def _normalized_votes(table, owner_column, owner_mbids=None):
+    """
+    (owner_mbid, tag, weight) with votes relative to the owner's most voted
+    tag, for owner_mbids (a list or select) or every owner if None
+    """
+    max_votes = (
+        select(owner_column.label('owner_mbid'), func.max(table.tag_votes).label('votes'))
+        .group_by(owner_column)
+    )
+    if owner_mbids is not None:
+        max_votes = max_votes.where(owner_column.in_(owner_mbids))
+    max_votes = max_votes.subquery()
+
+    weights = (
+        select(
+            owner_column.label('owner_mbid'),
+            table.tag,
+            case(
+                (max_votes.c.votes > 0, func.cast(table.tag_votes, Float) / max_votes.c.votes),
+                else_=1.0
+            ).label('weight')
+        )
+        .join(max_votes, max_votes.c.owner_mbid == owner_column)
+    )
+    if owner_mbids is not None:
+        weights = weights.where(owner_column.in_(owner_mbids))
+
+    return weights.subquery()
+
+
+if __name__ == '__main__':
+    main()
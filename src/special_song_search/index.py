@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import heapq
+import random
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy import select
+
+from special_song_search.database import read_transaction
+from special_song_search.recommend import query_params
+from special_song_search.snapshot import NO_LENGTH, NO_YEAR, parse_year
+from special_song_search.models import (
+    artist_recording_association,
+    ArtistTag,
+    Recording, RecordingTag
+)
+
+
+# Recordings kept from the tag-only top-k per recording returned, leaving
+# room for the length/date penalty and randomness to reorder them
+CANDIDATES_PER_RESULT = 4
+
+
+class PostingList:
+    """ Recording ids with a tag, ascending, and their weights for the tag """
+    __slots__ = ('ids', 'weights', 'max_weight')
+
+    def __init__(self, weights_by_id: dict[int, float]):
+        ids = sorted(weights_by_id)
+        self.ids = array('i', ids)
+        self.weights = array('f', (weights_by_id[id_] for id_ in ids))
+        self.max_weight = max(self.weights, default=0.0)
+
+
+class TagIndex:
+    """
+    In-memory inverted index of artist and recording tags.
+
+    Each (tag type, tag) has a PostingList. A recording's weight for a
+    recording tag is its votes relative to the recording's most voted tag;
+    for an artist tag it is the same for the recording's artists, taking the
+    best artist. Unlike recommend(), which scores a recording by its single
+    best tag, a query's tag score here is the sum over its tags of
+    query weight * type weight * posting weight, which is what lets MaxScore
+    skip recordings that cannot reach the current top-k.
+    """
+
+    def __init__(
+            self,
+            recording_mbids: list[str],
+            lengths: array,
+            years: array,
+            postings: dict[tuple[str, str], PostingList]
+        ):
+        self.recording_mbids = recording_mbids
+        self.lengths = lengths
+        self.years = years
+        self.postings = postings
+        # Recordings fully scored by the last top_k call
+        self.last_scored = 0
+
+    @classmethod
+    def from_session(cls, session) -> 'TagIndex':
+        """
+        Build the index from the database, read in one read_transaction so
+        a concurrent crawl cannot commit between its SELECTs
+        """
+        with read_transaction(session) as reader:
+            return cls._from_rows(reader)
+
+    @classmethod
+    def _from_rows(cls, session) -> 'TagIndex':
+        recordings = session.execute(
+            select(Recording.mbid, Recording.length, Recording.date)
+        ).fetchall()
+        recordings.sort(key=lambda recording: recording.mbid)
+        ids = {recording.mbid: n for n, recording in enumerate(recordings)}
+        lengths = array('i', (
+            NO_LENGTH if recording.length is None else recording.length
+            for recording in recordings
+        ))
+        years = array('h', (
+            parse_year(recording.date) for recording in recordings
+        ))
+
+        postings = dict()
+
+        recording_tags = _normalized_votes(session.execute(
+            select(RecordingTag.recording_mbid, RecordingTag.tag, RecordingTag.tag_votes)
+        ))
+        for recording_mbid, tags in recording_tags.items():
+            recording_id = ids[recording_mbid]
+            for tag, weight in tags.items():
+                postings.setdefault(('recording', tag), dict())[recording_id] = weight
+        del recording_tags
+
+        artist_tags = _normalized_votes(session.execute(
+            select(ArtistTag.artist_mbid, ArtistTag.tag, ArtistTag.tag_votes)
+        ))
+        associations = session.execute(
+            select(
+                artist_recording_association.c.artist_mbid,
+                artist_recording_association.c.recording_mbid
+            )
+        )
+        for artist_mbid, recording_mbid in associations:
+            recording_id = ids[recording_mbid]
+            for tag, weight in artist_tags.get(artist_mbid, dict()).items():
+                posting = postings.setdefault(('artist', tag), dict())
+                if weight > posting.get(recording_id, -1.0):
+                    posting[recording_id] = weight
+        del artist_tags
+
+        return cls(
+            recording_mbids=[recording.mbid for recording in recordings],
+            lengths=lengths,
+            years=years,
+            postings={key: PostingList(posting) for key, posting in postings.items()}
+        )
+
+    def recommend(self, seed: int | None = None, **query) -> list[dict]:
+        """
+        Top recordings for a query given as recommend() keyword arguments.
+
+        Range filters are applied while traversing the postings. The length
+        and date penalties and the random term are applied afterwards to
+        the CANDIDATES_PER_RESULT * limit best recordings by tag score.
+        seed_artist raises ValueError; pass the tags from seed_artist_tags
+        instead.
+        """
+        params = query_params(0, **query)
+        limit = params['limit']
+        weights = query.get('weights', dict())
+        terms = [
+            (
+                self.postings[(tag_type, tag)],
+                tag_weight * weights[f'{tag_type}_tags']
+            )
+            for tag_type in ('artist', 'recording')
+            if f'{tag_type}_tags' in weights
+            for tag, tag_weight in query.get(f'{tag_type}_tags', dict()).items()
+            if (tag_type, tag) in self.postings
+        ]
+
+        candidates = self.top_k(
+            terms, CANDIDATES_PER_RESULT * limit, self._range_filter(params)
+        )
+
+        rng = random.Random(seed)
+        noise_scale = 2.**64 / params['random_normal'] * params['randomness']
+        results = []
+        for tag_score, recording_id in candidates:
+            score = tag_score
+            if params['length_center'] is not None:
+                length = self.lengths[recording_id]
+                if length == NO_LENGTH:
+                    continue
+                score -= (
+                    abs(length / 1_000 - params['length_center'])
+                    * params['points_per_second']
+                )
+            if params['date_center'] is not None:
+                year = self.years[recording_id]
+                if year == NO_YEAR:
+                    continue
+                score -= abs(year - params['date_center']) * params['points_per_year']
+            filter_score = score + (rng.random() - 0.5) * noise_scale
+            results.append((filter_score, score, recording_id))
+
+        return [
+            {
+                'filter_score': filter_score,
+                'score': score,
+                'recording_mbid': self.recording_mbids[recording_id]
+            }
+            for filter_score, score, recording_id in heapq.nlargest(limit, results)
+        ]
+
+    def top_k(
+            self,
+            terms: list[tuple[PostingList, float]],
+            k: int,
+            accept=None
+        ) -> list[tuple[float, int]]:
+        """
+        MaxScore top-k of (score, recording id) by summed term weights.
+
+        terms are (posting list, query weight) pairs and accept, if given,
+        filters recording ids. Terms are ordered by their largest possible
+        contribution, longest list first among equals; once the k-th best
+        score exceeds the combined bound of the weakest terms, only
+        recordings in the remaining "essential" terms are visited and the
+        weak terms are only probed, by binary search, while they could still
+        lift a recording into the top-k.
+        """
+        self.last_scored = 0
+        if k <= 0 or not terms:
+            return []
+
+        # Weights are relative to each owner's top tag, so bounds often tie;
+        # longer lists are then made non-essential first
+        terms = sorted(
+            terms,
+            key=lambda term: (max(0.0, term[0].max_weight * term[1]), -len(term[0].ids))
+        )
+        postings = [posting for posting, _ in terms]
+        query_weights = [query_weight for _, query_weight in terms]
+        bounds = [
+            max(0.0, posting.max_weight * query_weight)
+            for posting, query_weight in terms
+        ]
+        # bound_sums[i] is the best total of terms[:i]
+        bound_sums = [0.0]
+        for bound in bounds:
+            bound_sums.append(bound_sums[-1] + bound)
+
+        cursors = [0] * len(terms)
+        heap = []
+        threshold = float('-inf')
+        first_essential = 0
+
+        while True:
+            candidate = None
+            for term in range(first_essential, len(terms)):
+                if cursors[term] < len(postings[term].ids):
+                    id_ = postings[term].ids[cursors[term]]
+                    if candidate is None or id_ < candidate:
+                        candidate = id_
+            if candidate is None:
+                break
+
+            score = 0.0
+            for term in range(first_essential, len(terms)):
+                ids = postings[term].ids
+                if cursors[term] < len(ids) and ids[cursors[term]] == candidate:
+                    score += query_weights[term] * postings[term].weights[cursors[term]]
+                    cursors[term] += 1
+
+            if accept is not None and not accept(candidate):
+                continue
+
+            for term in reversed(range(first_essential)):
+                if score + bound_sums[term + 1] <= threshold:
+                    break
+                ids = postings[term].ids
+                cursors[term] = bisect_left(ids, candidate, cursors[term])
+                if cursors[term] < len(ids) and ids[cursors[term]] == candidate:
+                    score += query_weights[term] * postings[term].weights[cursors[term]]
+            self.last_scored += 1
+
+            if len(heap) < k:
+                heapq.heappush(heap, (score, candidate))
+            elif score > threshold:
+                heapq.heapreplace(heap, (score, candidate))
+            else:
+                continue
+
+            if len(heap) == k:
+                threshold = heap[0][0]
+                while (
+                        first_essential < len(terms)
+                        and bound_sums[first_essential + 1] <= threshold
+                    ):
+                    first_essential += 1
+
+        return sorted(heap, reverse=True)
+
+    def _range_filter(self, params: dict):
+        checks = []
+        if params['length_min'] is not None or params['length_max'] is not None:
+            length_min = params['length_min']
+            length_max = params['length_max']
+            lengths = self.lengths
+
+            def length_in_range(recording_id: int) -> bool:
+                length = lengths[recording_id]
+                if length == NO_LENGTH:
+                    return False
+                seconds = length / 1_000
+                return (
+                    (length_min is None or length_min <= seconds)
+                    and (length_max is None or seconds <= length_max)
+                )
+            checks.append(length_in_range)
+
+        if params['date_min'] is not None or params['date_max'] is not None:
+            date_min = params['date_min']
+            date_max = params['date_max']
+            years = self.years
+
+            def year_in_range(recording_id: int) -> bool:
+                year = years[recording_id]
+                if year == NO_YEAR:
+                    return False
+                return (
+                    (date_min is None or date_min <= year)
+                    and (date_max is None or year <= date_max)
+                )
+            checks.append(year_in_range)
+
+        if not checks:
+            return None
+        return lambda recording_id: all(check(recording_id) for check in checks)
+
+def _normalized_votes(rows) -> dict[str, dict[str, float]]:
+    """ {owner: {tag: votes / owner's max votes}} from (owner, tag, votes) rows """
+    votes = dict()
+    for owner, tag, tag_votes in rows:
+        votes.setdefault(owner, dict())[tag] = max(tag_votes, 0)
+
+    normalized = dict()
+    for owner, tags in votes.items():
+        max_votes = max(tags.values())
+        normalized[owner] = {
+            tag: tag_votes / max_votes if max_votes else 1.0
+            for tag, tag_votes in tags.items()
+        }
+    return normalized
@@ -8,6 +8,7 @@ from sqlalchemy import String
 from sqlalchemy import Column
 from sqlalchemy import Table
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import DeclarativeBase
@@ -78,3 +79,34 @@ class RecordingTag(Base):
     tag: Mapped[str] = mapped_column(String(40), primary_key=True)
     tag_votes: Mapped[int] = mapped_column()
 
+
+class RecordingFeature(Base):
+    """
+    Denormalized tag weights per recording, see features.py
+
+    source is 'artist' for tags of the recording's artists and 'recording'
+    for its own tags. weight is the tag's votes relative to its owner's most
+    voted tag, taking the best artist for artist tags.
+    """
+    __tablename__ = 'recording_feature'
+    __table_args__ = (Index('recording_feature_tag', 'source', 'tag'),)
+
+    recording_mbid: Mapped[str] = mapped_column(String(40), ForeignKey('recording.mbid'), primary_key=True)
+    source: Mapped[str] = mapped_column(String(10), primary_key=True)
+    tag: Mapped[str] = mapped_column(String(40), primary_key=True)
+    weight: Mapped[float] = mapped_column()
+
+
+class CatalogGeneration(Base):
+    """
+    One row counting catalog writes, see database.catalog_generation
+
+    Ingestion increments generation in the same commit as each batch.
+    catalog_id is random, so a rebuilt database does not repeat the
+    generations of the one it replaced.
+    """
+    __tablename__ = 'catalog_generation'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    catalog_id: Mapped[str] = mapped_column(String(40))
+    generation: Mapped[int] = mapped_column()
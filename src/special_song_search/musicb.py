@@ -6,6 +6,9 @@ import musicbrainzngs
 import pandas as pd
 from dotenv import load_dotenv
 from os import environ
+from typing import Callable, Iterator
+
+from special_song_search.ratelimit import SharedRateLimiter
 
 
 # API LIMITS and links
@@ -21,6 +24,35 @@ MAX_ARTIST_RECORDINGS = 5000
 # Environment
 load_dotenv()
 
+# Set by connect_to_musicbrainz when rate limiting is shared across processes
+_shared_limiter = None
+
+class Record:
+    """ Flattened API entity whose slots are its table's column names """
+    __slots__ = ()
+
+    def __init__(self, **columns):
+        for column in self.__slots__:
+            setattr(self, column, columns.get(column))
+
+    def row(self) -> dict:
+        return {column: getattr(self, column) for column in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.row()!r})'
+
+class ArtistRecord(Record):
+    __slots__ = ('mbid', 'name', 'disambiguation', 'type', 'gender', 'country',
+                 'life_span_begin', 'life_span_end', 'rating_votes', 'rating')
+
+class RecordingRecord(Record):
+    __slots__ = ('mbid', 'title', 'disambiguation', 'length', 'date',
+                 'rating_votes', 'rating', 'release_status')
+
+class TagRecord(Record):
+    __slots__ = ('mbid', 'tag', 'tag_votes')
+
+
 def main() -> None:
     from argparse import ArgumentParser
     parser = ArgumentParser()
@@ -37,83 +69,109 @@ def main() -> None:
     globals().update({'artists': artists})
 
     recs = get_artist_recordings(
-            artist_mbid=artists[0][0]['id'], n_recordings=args.n_recordings, verbose=args.verbose)
+            artist_mbid=artists[0][0].mbid, n_recordings=args.n_recordings, verbose=args.verbose)
     globals().update({'recs': recs})
 
     return
 
-def connect_to_musicbrainz(verbose: bool = False) -> None:
+def connect_to_musicbrainz(verbose: bool = False, shared_rate_limit: str = '') -> None:
+    """
+    Authenticate and set the user agent and rate limit.
+
+    shared_rate_limit is the path of a SharedRateLimiter file. If given, the
+    per-process musicbrainzngs limit is replaced by buckets in that file, one
+    per API host and one per credential, shared by every process using it.
+    """
+    global _shared_limiter
+
     if verbose:
         print('setting user agent')
 
     musicbrainzngs.auth(environ.get('MBUA_USERNAME'), environ.get('MBUA_PASSWORD'))
     musicbrainzngs.set_useragent(environ.get('MBUA_APP'), environ.get('MBUA_VERSION'), environ.get('MBUA_CONTACT'))
-    musicbrainzngs.set_rate_limit(limit_or_interval=RATE, new_requests=NEW_REQUESTS)
+
+    if shared_rate_limit:
+        musicbrainzngs.set_rate_limit(limit_or_interval=False)
+        budget = (NEW_REQUESTS / RATE, NEW_REQUESTS)
+        credential = environ.get('MBUA_USERNAME') or environ.get('MBUA_APP')
+        _shared_limiter = SharedRateLimiter(
+            budgets={
+                f'host:{musicbrainzngs.musicbrainz.hostname}': budget,
+                f'credential:{credential}': budget
+            },
+            path=shared_rate_limit
+        )
+    else:
+        musicbrainzngs.set_rate_limit(limit_or_interval=RATE, new_requests=NEW_REQUESTS)
+        _shared_limiter = None
 
     if verbose:
         print('User agent set')
 
     return
 
+def throttle() -> None:
+    """ Wait for the shared rate limiter, if any, before an API call """
+    if _shared_limiter is not None:
+        _shared_limiter.acquire()
+
 def get_artists_from_country(
         country_code: str,
         n_artists: int,
         offset: int = 0,
         verbose: bool = False
     ) -> list[tuple]:
+    return list(iter_artists_from_country(country_code, n_artists, offset, verbose))
+
+def iter_artists_from_country(
+        country_code: str,
+        n_artists: int,
+        offset: int = 0,
+        verbose: bool = False
+    ) -> Iterator[tuple[ArtistRecord, list[TagRecord]]]:
+    """ Yield flattened (artist, tags) from country_code one page at a time """
     n_pages = max(1, n_artists // SEARCH_BROWSE_LIMIT)
     limit = n_artists if n_pages == 1 else SEARCH_BROWSE_LIMIT
 
-    artists = []
     for page_n in range(n_pages):
         if verbose:
             print(f'Getting artists from {country_code}, page {page_n}')
+        throttle()
         page = musicbrainzngs.search_artists(
             query='',
             country=country_code,
             offset=offset + page_n * limit,
             limit=limit
         )
-        page_artists = page['artist-list']
-        artists += page_artists
-
-    return [artist_flattened(artist) for artist in artists]
+        for artist in page['artist-list']:
+            yield artist_flattened(artist)
 
 def get_artist_info(artist_mbid: str) -> dict:
     """ Get detailed artist information given mbid """
     includes = ['ratings']
 
+    throttle()
     return musicbrainzngs.get_artist_by_id(id=artist_mbid, includes=includes)
 
-def artist_flattened(artist: dict) -> tuple[dict, list]:
-    artist_keys_to_keep = {'id', 'type', 'name', 'disambiguation', 'gender',
-                           'country', 'life-span', 'tag-list', 'rating'}
-
-    artist_flat = dict()
-    artist_tags = []
+def artist_flattened(artist: dict) -> tuple[ArtistRecord, list[TagRecord]]:
     artist_nest = artist['artist'] if 'artist' in artist else artist
+    life_span = artist_nest.get('life-span', dict())
+    rating = artist_nest.get('rating', dict())
+
+    artist_record = ArtistRecord(
+        mbid=artist_nest['id'],
+        name=artist_nest.get('name'),
+        disambiguation=artist_nest.get('disambiguation'),
+        type=artist_nest.get('type'),
+        gender=artist_nest.get('gender'),
+        country=artist_nest.get('country'),
+        life_span_begin=life_span.get('begin'),
+        life_span_end=life_span.get('end'),
+        rating_votes=_int_or_none(rating.get('votes-count')),
+        rating=_float_or_none(rating.get('rating'))
+    )
 
-    for key, value in  artist_nest.items():
-        if key not in artist_keys_to_keep:
-            continue
-
-        if isinstance(value, str):
-            artist_flat[key] = value
-
-        elif isinstance(value, dict):
-            if key == 'rating':
-                artist_flat['rating_votes'] = int(value['votes-count'])
-                artist_flat['rating'] = float(value['rating'])
-            elif key == 'life-span':
-                for time in ('begin', 'end'):
-                    if time in value:
-                        artist_flat[f'life_span_{time}'] = value[time]
-
-        elif isinstance(value, list):
-            if key == 'tag-list':
-                artist_tags = value
-
-    return artist_flat, artist_tags
+    return artist_record, _tag_records(artist_record.mbid, artist_nest)
 
 def get_artist_recordings(
         artist_mbid: str,
@@ -121,6 +179,23 @@ def get_artist_recordings(
         detailed: bool = True,
         verbose: bool = False
     ) -> list[tuple]:
+    return list(iter_artist_recordings(artist_mbid, n_recordings, detailed, verbose))
+
+def iter_artist_recordings(
+        artist_mbid: str,
+        n_recordings: int = -1,
+        detailed: bool = True,
+        verbose: bool = False,
+        known_mbids: Callable[[list[str]], set[str]] | None = None
+    ) -> Iterator[tuple[RecordingRecord, list[TagRecord] | None]]:
+    """
+    Yield flattened (recording, tags) of an artist one page at a time.
+
+    With detailed, each recording of a page is looked up before the next
+    page is browsed. known_mbids, if given, is called with each page's mbids
+    and returns those already stored; these are yielded from the browse
+    response with tags None and without a detail lookup.
+    """
     includes = ['artist-credits', 'tags', 'ratings']
 
     if n_recordings != -1 and n_recordings < MAX_ARTIST_RECORDINGS:
@@ -130,10 +205,10 @@ def get_artist_recordings(
 
     limit = n_recordings if n_pages == 1 else SEARCH_BROWSE_LIMIT
 
-    recordings = []
     for page_n in range(n_pages):
         if verbose:
             print(f'Getting recordings from artist {artist_mbid}, page {page_n}')
+        throttle()
         page = musicbrainzngs.browse_recordings(
             artist=artist_mbid,
             includes=includes,
@@ -141,18 +216,24 @@ def get_artist_recordings(
             limit=limit
         )
         page_recordings = page['recording-list']
-        recordings += page_recordings
 
-        if len(page_recordings) < SEARCH_BROWSE_LIMIT:
-            break
+        if known_mbids is not None:
+            known = known_mbids([recording['id'] for recording in page_recordings])
+        else:
+            known = set()
 
-    if detailed:
-        if verbose:
+        if detailed and verbose:
             print('Getting recording(s) details')
-        mbids = [recording['id'] for recording in recordings]
-        return [recording_flattened(get_recording_info(mbid)) for mbid in mbids]
+        for recording in page_recordings:
+            if recording['id'] in known:
+                yield recording_flattened(recording)[0], None
+            elif detailed:
+                yield recording_flattened(get_recording_info(recording['id']))
+            else:
+                yield recording_flattened(recording)
 
-    return [recording_flattened(recording) for recording in recordings]
+        if len(page_recordings) < SEARCH_BROWSE_LIMIT:
+            break
 
 def get_recording_info(recording_mbid: str) -> dict:
     """ Get detailed recording information given mbid """
@@ -160,6 +241,7 @@ def get_recording_info(recording_mbid: str) -> dict:
     release_type = ['album', 'single', 'ep']
     release_status = ['official']
 
+    throttle()
     return musicbrainzngs.get_recording_by_id(
         id=recording_mbid,
         includes=includes,
@@ -167,42 +249,65 @@ def get_recording_info(recording_mbid: str) -> dict:
         release_status=release_status
     )
 
-def recording_flattened(recording: dict) -> tuple[dict, list]:
-    recording_keys_to_keep = {'id', 'title', 'length', 'disambiguation',
-                              'release-list', 'tag-list', 'rating',
-                              'artist-credit-phrase'}
-
-    recording_flat = dict()
-    recording_tags = []
+def recording_flattened(recording: dict) -> tuple[RecordingRecord, list[TagRecord]]:
     recording_nest = recording['recording'] if 'recording' in recording else recording
+    rating = recording_nest.get('rating', dict())
+    releases = recording_nest.get('release-list')
 
-    for key, value in  recording_nest.items():
-        if key not in recording_keys_to_keep:
-            continue
+    if releases:
+        first_release = min(
+            releases,
+            key=lambda release: release.get('date', '99999')
+        )
+        date = first_release.get('date', None)
+        release_status = 'official'
+    else:
+        date = None
+        release_status = None
+
+    recording_record = RecordingRecord(
+        mbid=recording_nest['id'],
+        title=recording_nest.get('title'),
+        disambiguation=recording_nest.get('disambiguation'),
+        length=_int_or_none(recording_nest.get('length')),
+        date=date,
+        rating_votes=_int_or_none(rating.get('votes-count')),
+        rating=_float_or_none(rating.get('rating')),
+        release_status=release_status
+    )
 
-        if isinstance(value, str):
-            if key == 'length':
-                recording_flat[key] = int(value)
-            else:
-                recording_flat[key] = value
-
-        elif isinstance(value, dict):
-            if key == 'rating':
-                recording_flat['rating_votes'] = int(value['votes-count'])
-                recording_flat['rating'] = float(value['rating'])
-
-        elif isinstance(value, list):
-            if (key == 'release-list') and value:
-                first_release = min(
-                    value,
-                    key=lambda release: release.get('date', '99999')
-                )
-                recording_flat['date'] = first_release.get('date', None)
-                recording_flat['release_status'] = 'official'
-            elif key == 'tag-list':
-                recording_tags = value
-
-    return recording_flat, recording_tags
+    return recording_record, _tag_records(recording_record.mbid, recording_nest)
+
+def table_batches(
+        records: list[tuple],
+        owner_column: str
+    ) -> tuple[list[dict], list[dict]]:
+    """
+    Rows of an entity table and of its tag table from flattened records.
+
+    records are (record, tags) tuples and owner_column names the tag table's
+    column referencing the entity. Rows are dicts of column values, ready
+    for an executemany insert.
+    """
+    entity_rows = [record.row() for record, _ in records]
+    tag_rows = [
+        {owner_column: tag.mbid, 'tag': tag.tag, 'tag_votes': tag.tag_votes}
+        for _, tags in records
+        for tag in tags or ()
+    ]
+    return entity_rows, tag_rows
+
+def _tag_records(mbid: str, entity: dict) -> list[TagRecord]:
+    return [
+        TagRecord(mbid=mbid, tag=tag['name'], tag_votes=int(tag['count']))
+        for tag in entity.get('tag-list', ())
+    ]
+
+def _int_or_none(value) -> int | None:
+    return None if value is None else int(value)
+
+def _float_or_none(value) -> float | None:
+    return None if value is None else float(value)
 
 
 if __name__ == '__main__':
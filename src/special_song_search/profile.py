@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Profile recommend and ingestion workloads.
+
+    python -m special_song_search.profile recommend queries.jsonl --database sqlite:///sample.db
+    python -m special_song_search.profile ingest US 10 50 --fixtures fixtures/ --record
+    python -m special_song_search.profile ingest US 10 50 --fixtures fixtures/
+
+Each run makes two passes over the workload: one under cProfile, written
+to OUTPUT.pstats (for pstats or snakeviz), and one sampled, written to
+OUTPUT.collapsed (for flamegraph.pl or speedscope). The sampled pass's wall
+time is printed split into SQL, MusicBrainz API wait and Python CPU.
+"""
+
+
+import cProfile
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, closing
+from typing import Callable, Iterator
+
+import musicbrainzngs
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.engine.base import Engine
+
+from special_song_search import musicb
+from special_song_search.database import (
+    init_db,
+    fill_artists_and_recordings,
+    SERVING,
+    INGEST
+)
+from special_song_search.recommend import recommend, recommend_many
+from special_song_search.cache import read_queries
+
+
+# musicbrainzngs functions called by musicb.py
+API_FUNCTIONS = (
+    'search_artists',
+    'get_artist_by_id',
+    'browse_recordings',
+    'get_recording_by_id'
+)
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Profile recommend or ingestion workloads')
+    parser.add_argument('--output', dest='output', type=str, default='',
+                        help='Output path prefix, default profile-<command>')
+    parser.add_argument('--interval', dest='interval', type=float,
+                        default=SAMPLE_INTERVAL, help='Seconds between stack samples')
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recommend_parser = commands.add_parser(
+        'recommend', help='Replay a JSONL file of recommend() keyword arguments'
+    )
+    recommend_parser.add_argument('queries', type=str,
+                                  help='JSONL file, one query per line')
+    recommend_parser.add_argument('--database', dest='database', type=str, default='',
+                                  help=('Database connection string\n'
+                                        +'Empty string creates/uses sqlite test.db\n'
+                                        +"'main' creates/uses $DATABASE_STR"
+                                       )
+                                  )
+    recommend_parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+                                  help='Times to replay the query file')
+    recommend_parser.add_argument('--many', dest='many', action='store_true',
+                                  default=False,
+                                  help='Score each replay with one recommend_many() call')
+
+    ingest_parser = commands.add_parser(
+        'ingest', help='Fill artists and recordings from recorded API responses'
+    )
+    ingest_parser.add_argument('country_code', type=str,
+                               help='Country from which to get artists')
+    ingest_parser.add_argument('n_artists', type=int,
+                               help='Number of artists to add to database')
+    ingest_parser.add_argument('n_recordings', type=int,
+                               help='Max recordings per artist, -1 to use max given in musicb.py')
+    ingest_parser.add_argument('--fixtures', dest='fixtures', type=str, required=True,
+                               help='Directory of recorded API responses')
+    ingest_parser.add_argument('--record', dest='record', action='store_true',
+                               default=False,
+                               help=('Call the MusicBrainz API and record its responses '
+                                     +'instead of replaying them')
+                              )
+    ingest_parser.add_argument('--database', dest='database', type=str, default='',
+                               help=('Database connection string\n'
+                                     +'SQLite only, copied for each pass\n'
+                                     +'Empty string uses a new temporary sqlite database'
+                                    )
+                               )
+    args = parser.parse_args()
+
+    output = args.output or f'profile-{args.command}'
+    if args.command == 'recommend':
+        profile_recommend(
+            args.queries, args.database, args.repeat, args.many,
+            output, args.interval, args.verbose
+        )
+    elif args.command == 'ingest':
+        profile_ingest(
+            args.country_code, args.n_artists, args.n_recordings, args.fixtures,
+            args.record, args.database, output, args.interval, args.verbose
+        )
+
+    return
+
+def profile_recommend(
+        queries_path: str,
+        database: str,
+        repeat: int,
+        many: bool,
+        output: str,
+        interval: float = SAMPLE_INTERVAL,
+        verbose: bool = False
+    ) -> dict:
+    """ Profile replaying the queries repeat times """
+    queries = read_queries(queries_path)
+    engine, Session = init_db(database, verbose=verbose, profile=SERVING)
+
+    @contextmanager
+    def setup() -> Iterator[tuple[Callable[[], None], Engine]]:
+        with Session() as session:
+            def workload():
+                for _ in range(repeat):
+                    if many:
+                        recommend_many(session, queries)
+                    else:
+                        for query in queries:
+                            recommend(session, **query)
+
+            yield workload, engine
+
+    return run_profiled(setup, output, interval)
+
+def profile_ingest(
+        country_code: str,
+        n_artists: int,
+        n_recordings: int,
+        fixtures: str,
+        record: bool,
+        database: str,
+        output: str,
+        interval: float = SAMPLE_INTERVAL,
+        verbose: bool = False
+    ) -> dict:
+    """
+    Profile filling artists and recordings from country_code.
+
+    Responses are replayed from fixtures, or with record fetched from the
+    API (which must be configured as for database.py) and saved there.
+    Replays are not rate limited; recording calls the API in both passes.
+    Each pass starts from a new temporary SQLite database or, with
+    database, a copy of it, so both passes make the same calls. database
+    must therefore be a SQLite file, which is left unchanged.
+    """
+    source = make_url(database) if database else None
+    if source is not None and (
+            source.get_backend_name() != 'sqlite'
+            or source.database in (None, '', ':memory:')
+        ):
+        raise ValueError(
+            'database must be a SQLite file, copied for each profiling pass'
+        )
+
+    if record:
+        musicb.connect_to_musicbrainz(verbose=verbose)
+    responses = RecordedResponses(fixtures, record)
+
+    @contextmanager
+    def setup() -> Iterator[tuple[Callable[[], None], Engine]]:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'ingest.db')
+            if source is not None:
+                # backup() also copies changes still in the source's WAL
+                with (
+                        closing(sqlite3.connect(source.database)) as original,
+                        closing(sqlite3.connect(path)) as copy
+                    ):
+                    original.backup(copy)
+            engine, Session = init_db(f'sqlite:///{path}', verbose=verbose, profile=INGEST)
+
+            with Session() as session, responses.installed():
+                def workload():
+                    fill_artists_and_recordings(
+                        session=session,
+                        country_code=country_code,
+                        n_artists=n_artists,
+                        n_recordings=n_recordings,
+                        verbose=verbose
+                    )
+
+                yield workload, engine
+            engine.dispose()
+
+    return run_profiled(setup, output, interval)
+
+def run_profiled(
+        setup: Callable,
+        output: str,
+        interval: float = SAMPLE_INTERVAL
+    ) -> dict:
+    """
+    Profile the workload given by setup in two passes, writing
+    output.pstats and output.collapsed, and print and return its time
+    breakdown.
+
+    setup is a context manager yielding (workload, engine), entered once per
+    pass. The first pass runs under cProfile. The second, which the time
+    breakdown comes from, is only sampled, so neither cProfile's tracing
+    nor the sampler's own CPU time is counted in it.
+    """
+    profiler = cProfile.Profile()
+    with setup() as (workload, _):
+        profiler.runcall(workload)
+    profiler.dump_stats(f'{output}.pstats')
+
+    timers = WorkloadTimers()
+    sampler = StackSampler(threading.get_ident(), interval)
+    with setup() as (workload, engine):
+        with timers.timing_sql(engine), timers.timing_api():
+            sampler.start()
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                workload()
+            finally:
+                wall = time.perf_counter() - wall_start
+                cpu = time.process_time() - cpu_start
+                sampler.stop()
+    sampler.write(f'{output}.collapsed')
+
+    summary = timers.summary(wall, cpu - sampler.cpu)
+    summary['samples'] = sampler.n_samples
+    for key, value in summary.items():
+        print(f'{key:<16} {value:.3f}' if isinstance(value, float) else f'{key:<16} {value}')
+    print(f'Wrote {output}.pstats and {output}.collapsed')
+
+    return summary
+
+
+class WorkloadTimers:
+    """
+    Wall and CPU time spent executing SQL (from engine cursor events) and
+    waiting on the MusicBrainz API (its calls and rate limiting)
+    """
+
+    def __init__(self):
+        self.sql_wall = 0.
+        self.sql_cpu = 0.
+        self.sql_statements = 0
+        self.api_wall = 0.
+        self.api_cpu = 0.
+        self.api_calls = 0
+
+    @contextmanager
+    def timing_sql(self, engine: Engine) -> Iterator[None]:
+        def before(connection, cursor, statement, parameters, context, executemany):
+            connection.info.setdefault('profile_start', []).append(
+                (time.perf_counter(), time.process_time())
+            )
+
+        def after(connection, cursor, statement, parameters, context, executemany):
+            wall_start, cpu_start = connection.info['profile_start'].pop()
+            self.sql_wall += time.perf_counter() - wall_start
+            self.sql_cpu += time.process_time() - cpu_start
+            self.sql_statements += 1
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+        try:
+            yield
+        finally:
+            event.remove(engine, 'before_cursor_execute', before)
+            event.remove(engine, 'after_cursor_execute', after)
+
+    @contextmanager
+    def timing_api(self) -> Iterator[None]:
+        """ Time the API functions, and musicb.throttle, as installed on entry """
+        originals = {name: getattr(musicbrainzngs, name) for name in API_FUNCTIONS}
+        original_throttle = musicb.throttle
+
+        def timed(function, counted):
+            def wrapper(*args, **kwargs):
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.api_wall += time.perf_counter() - wall_start
+                    self.api_cpu += time.process_time() - cpu_start
+                    self.api_calls += counted
+            return wrapper
+
+        for name, function in originals.items():
+            setattr(musicbrainzngs, name, timed(function, 1))
+        musicb.throttle = timed(original_throttle, 0)
+        try:
+            yield
+        finally:
+            for name, function in originals.items():
+                setattr(musicbrainzngs, name, function)
+            musicb.throttle = original_throttle
+
+    def summary(self, wall: float, cpu: float) -> dict:
+        """ Seconds of wall time by where they went, plus call counts """
+        python_cpu = cpu - self.sql_cpu - self.api_cpu
+        return {
+            'wall': wall,
+            'sql': self.sql_wall,
+            'api_wait': self.api_wall,
+            'python_cpu': python_cpu,
+            # e.g. result fetching, lazy loads outside cursor execute, GC pauses
+            'other': wall - self.sql_wall - self.api_wall - python_cpu,
+            'sql_statements': self.sql_statements,
+            'api_calls': self.api_calls
+        }
+
+
+class StackSampler:
+    """ Collapsed stacks of one thread, sampled from a background thread """
+
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.n_samples = 0
+        # CPU seconds used by the sampler thread itself
+        self.cpu = 0.
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path: str) -> None:
+        """ One 'outer;...;inner count' line per distinct stack """
+        with open(path, 'w') as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write(f'{stack} {count}\n')
+
+    def _run(self) -> None:
+        cpu_start = time.thread_time()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.n_samples += 1
+        self.cpu = time.thread_time() - cpu_start
+
+
+class RecordedResponses:
+    """
+    musicbrainzngs responses stored as one JSON file per distinct call.
+
+    installed() replaces the API_FUNCTIONS with ones answering from
+    directory, or when recording with ones calling the API and saving
+    its responses there.
+    """
+
+    def __init__(self, directory: str, record: bool = False):
+        self.directory = directory
+        self.record = record
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, kwargs: dict) -> str:
+        key = json.dumps([name, kwargs], sort_keys=True)
+        return os.path.join(
+            self.directory, f'{name}-{hashlib.sha1(key.encode()).hexdigest()[:16]}.json'
+        )
+
+    @contextmanager
+    def installed(self) -> Iterator[None]:
+        originals = {name: getattr(musicbrainzngs, name) for name in API_FUNCTIONS}
+
+        def recorded(name):
+            def call(**kwargs):
+                path = self.path(name, kwargs)
+                if self.record:
+                    response = originals[name](**kwargs)
+                    with open(path, 'w') as response_file:
+                        json.dump({'function': name, 'kwargs': kwargs, 'response': response},
+                                  response_file)
+                    return response
+                if not os.path.exists(path):
+                    raise KeyError(f'No recorded response for {name}({kwargs}), '
+                                   +'record one with --record')
+                with open(path) as response_file:
+                    return json.load(response_file)['response']
+            return call
+
+        for name in API_FUNCTIONS:
+            setattr(musicbrainzngs, name, recorded(name))
+        try:
+            yield
+        finally:
+            for name, function in originals.items():
+                setattr(musicbrainzngs, name, function)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import os
+import sqlite3
+import tempfile
+import time
+
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'special_song_search_rate.db')
+
+
+class SharedRateLimiter:
+    """
+    Token buckets shared by every process on a host through a SQLite file.
+
+    budgets maps a bucket name (e.g. 'host:musicbrainz.org') to
+    (requests per second, burst). acquire() takes one token from every
+    bucket at once, inside a write transaction so processes never both take
+    the last token. When a bucket is empty the caller sleeps until the
+    earliest time a token can be available rather than polling.
+    """
+
+    def __init__(self, budgets: dict[str, tuple[float, float]], path: str = DEFAULT_PATH):
+        self.budgets = budgets
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS bucket ('
+            'name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def acquire(self) -> float:
+        """ Block until a request is allowed, returning the time waited """
+        waited = 0.0
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def _try_acquire(self) -> float:
+        """ Take a token from every bucket, or return how long to wait """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            tokens = dict()
+            for name, (rate, burst) in self.budgets.items():
+                row = connection.execute(
+                    'SELECT tokens, updated FROM bucket WHERE name = ?', (name,)
+                ).fetchone()
+                if row is None:
+                    tokens[name] = burst
+                else:
+                    bucket_tokens, updated = row
+                    tokens[name] = min(
+                        burst, bucket_tokens + max(0.0, now - updated) * rate
+                    )
+
+            wait = max(
+                (1.0 - tokens[name]) / rate
+                for name, (rate, _) in self.budgets.items()
+            )
+            if wait <= 0:
+                for name in tokens:
+                    tokens[name] -= 1.0
+            connection.executemany(
+                'INSERT OR REPLACE INTO bucket (name, tokens, updated) VALUES (?, ?, ?)',
+                [(name, bucket_tokens, now) for name, bucket_tokens in tokens.items()]
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        return wait
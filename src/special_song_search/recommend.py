@@ -2,17 +2,33 @@
 # coding: utf-8
 
 
+import json
+import sys
+from functools import lru_cache
+
 from sqlalchemy import select
 from sqlalchemy import func
+from sqlalchemy import case
+from sqlalchemy import or_
+from sqlalchemy import and_
+from sqlalchemy import null
+from sqlalchemy import union_all
+from sqlalchemy import text
+from sqlalchemy import column
+from sqlalchemy import bindparam
 from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import String
 from sqlalchemy import Date
 from sqlalchemy.engine.row import RowMapping
 
 from special_song_search.database import init_db
+from special_song_search.search import artist_tag_weights
 from special_song_search.models import (
     artist_recording_association,
     Artist, ArtistTag,
-    Recording, RecordingTag
+    Recording, RecordingTag,
+    RecordingFeature
 )
 
 
@@ -25,6 +41,77 @@ CENTER = 'center'
 POINTS_PER_SECOND = 'points_per_second'
 POINTS_PER_YEAR = 'points_per_year'
 
+# recommend() statements kept, one per query shape
+STATEMENT_CACHE_SIZE = 256
+
+# Columns of the per-call VALUES lists used by recommend_many
+_QUERY_COLUMNS = [
+    ('query_id', Integer),
+    ('length_min', Float),
+    ('length_max', Float),
+    ('length_center', Float),
+    (POINTS_PER_SECOND, Float),
+    ('date_min', Float),
+    ('date_max', Float),
+    ('date_center', Float),
+    (POINTS_PER_YEAR, Float),
+    ('randomness', Float),
+    ('random_normal', Float),
+    ('limit', Integer)
+]
+_QUERY_TAG_COLUMNS = [
+    ('query_id', Integer),
+    ('tag_type', String),
+    ('tag', String),
+    ('weight', Float)
+]
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('queries', type=str,
+                        help=('JSONL file of recommend() keyword arguments, '
+                              +"one query per line, '-' for stdin"
+                             )
+                       )
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR"
+                             )
+                        )
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.queries == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.queries) as queries_file:
+            lines = queries_file.readlines()
+    queries = [json.loads(line) for line in lines if line.strip()]
+    query_ids = [query.pop('id', query_n) for query_n, query in enumerate(queries)]
+
+    _, Session = init_db(args.database, verbose=args.verbose)
+    with Session() as session:
+        results = recommend_many(session, queries)
+
+        for query_id, recommendations in zip(query_ids, results):
+            print(json.dumps({
+                'id': query_id,
+                'recommendations': [
+                    {
+                        'mbid': rec['recording']['mbid'],
+                        'title': rec['recording']['title'],
+                        'artists': [artist['name'] for artist in rec['artists']],
+                        'score': rec['score'],
+                        'filter_score': rec['filter_score']
+                    }
+                    for rec in recommendations
+                ]
+            }))
+
+    return
+
 def recommend(
         session,
         artist_tags: dict[str, float] = dict(),
@@ -35,94 +122,585 @@ def recommend(
         recording_status: str = '',
         randomness: float = 1.,
         random_normal: float = 2.**64,
-        limit: int = 100
+        limit: int = 100,
+        seed_artist: str = '',
+        use_features: bool = False,
+        unique_recordings: bool = False,
+        max_per_artist: int | None = None
     ) -> list[dict]:
+    """
+    use_features scores from the recording_feature table (see features.py)
+    instead of joining through artists and tags. Only recordings matching at
+    least one weighted tag are then candidates, each returned once.
+
+    unique_recordings returns each recording at most once, and
+    max_per_artist (which implies unique_recordings) at most that many
+    recordings per artist, ranking by the artist's best matching tag when
+    artist tags are weighted and by the recording's first artist otherwise.
+    Both are applied in the query, before the limit.
 
-    artist_tags_score = 0.0
-    for tag, tag_weight in artist_tags.items():
-        artist_tags_score += (ArtistTag.tag == tag) * tag_weight
+    Tags, weights and conditions are bound parameters of a statement cached
+    by query shape (see _recommend_statement), so repeated shapes skip
+    building the expression and, through SQLAlchemy's compiled cache,
+    compiling it.
+    """
+
+    if seed_artist:
+        artist_tags, weights = seed_artist_tags(
+            session, seed_artist, artist_tags, weights
+        )
 
-    recording_tags_score = 0.0
-    for tag, tag_weight in recording_tags.items():
-        recording_tags_score += (RecordingTag.tag == tag) * tag_weight
+    # Tags of an unweighted type score nothing
+    artist_tags = artist_tags if 'artist_tags' in weights else dict()
+    recording_tags = recording_tags if 'recording_tags' in weights else dict()
+
+    length_condition = recording_length[f'{RECORDING_LENGTH}_{CONDITION}']
+    date_condition = recording_date[f'{RECORDING_DATE}_{CONDITION}']
+
+    statement = _recommend_statement(
+        artist_tag_slots=_tag_slots(len(artist_tags)),
+        recording_tag_slots=_tag_slots(len(recording_tags)),
+        join_artist_tags='artist_tags' in weights,
+        join_recording_tags='recording_tags' in weights,
+        length_condition=length_condition,
+        length_max=length_condition == RANGE and recording_length[RANGE][1] is not None,
+        date_condition=date_condition,
+        date_max=date_condition == RANGE and recording_date[RANGE][1] is not None,
+        use_features=use_features,
+        unique_recordings=unique_recordings or max_per_artist is not None,
+        max_per_artist=max_per_artist is not None
+    )
+
+    params = {
+        'artist_tags_weight': weights.get('artist_tags', 0.0),
+        'recording_tags_weight': weights.get('recording_tags', 0.0),
+        'randomness': randomness,
+        'random_normal': random_normal,
+        'limit': limit if limit < 100 else 100,
+        'max_per_artist': max_per_artist
+    }
+    for tag_type, tags in (('artist', artist_tags), ('recording', recording_tags)):
+        slots = _tag_slots(len(tags))
+        # Unused slots never match
+        tag_items = list(tags.items()) + [(None, 0.0)] * (slots - len(tags))
+        for slot, (tag, tag_weight) in enumerate(tag_items):
+            params[f'{tag_type}_tag_{slot}'] = tag
+            params[f'{tag_type}_tag_weight_{slot}'] = tag_weight
+
+    if length_condition == CENTER:
+        params['length_center'] = recording_length[CENTER]
+        params[POINTS_PER_SECOND] = recording_length[POINTS_PER_SECOND]
+    elif length_condition == RANGE:
+        params['length_min'], params['length_max'] = recording_length[RANGE]
+
+    if date_condition == CENTER:
+        params['date_center'] = recording_date[CENTER]
+        params[POINTS_PER_YEAR] = recording_date[POINTS_PER_YEAR]
+    elif date_condition == RANGE:
+        params['date_min'], params['date_max'] = recording_date[RANGE]
+
+    results = session.execute(statement, params).fetchall()
+    recommendations = [recommendation_dict(row._mapping) for row in results]
+
+    return recommendations
+
+def _tag_slots(n_tags: int) -> int:
+    """ Tag parameters for n_tags, rounded up to a power of two to share shapes """
+    return 0 if n_tags == 0 else 1 << (n_tags - 1).bit_length()
+
+@lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _recommend_statement(
+        artist_tag_slots: int,
+        recording_tag_slots: int,
+        join_artist_tags: bool,
+        join_recording_tags: bool,
+        length_condition: str,
+        length_max: bool,
+        date_condition: str,
+        date_max: bool,
+        use_features: bool,
+        unique_recordings: bool,
+        max_per_artist: bool
+    ):
+    """
+    recommend()'s statement for one query shape, with every value a bound
+    parameter named as in recommend()'s params
+    """
+
+    features = None
+    if use_features:
+        features = _feature_scores(artist_tag_slots, recording_tag_slots)
+
+    if features is not None:
+        tags_score = features.c.tag_score
+    else:
+        tags_score = (
+            _tag_weight(ArtistTag.tag, 'artist', artist_tag_slots)
+            * bindparam('artist_tags_weight', type_=Float)
+            + _tag_weight(RecordingTag.tag, 'recording', recording_tag_slots)
+            * bindparam('recording_tags_weight', type_=Float)
+        )
 
     score  = (
         func.cast(0, Float) # sqlalchemy func needed for label
-        + artist_tags_score * weights.get('artist_tags', 0.0)
-        + recording_tags_score * weights.get('recording_tags', 0.0)
+        + tags_score
     )
 
-    if recording_length[f'{RECORDING_LENGTH}_{CONDITION}'] == CENTER:
+    # Only year extract in cast because some rows only have years
+    recording_year = func.cast(Recording.date, Date)
+    recording_seconds = Recording.length / 1_000
+
+    if length_condition == CENTER:
         score -= (
-            func.abs(Recording.length / 1_000 - recording_length[CENTER])
-            * recording_length[POINTS_PER_SECOND]
+            func.abs(recording_seconds - bindparam('length_center', type_=Float))
+            * bindparam(POINTS_PER_SECOND, type_=Float)
         )
 
-    if recording_date[f'{RECORDING_DATE}_{CONDITION}'] == CENTER:
+    if date_condition == CENTER:
         score -= (
-            func.abs(
-                # Only year extract in cast because some rows only have years
-                func.cast(Recording.date, Date) - recording_date[CENTER]
-            )
-            * recording_date[POINTS_PER_YEAR]
+            func.abs(recording_year - bindparam('date_center', type_=Integer))
+            * bindparam(POINTS_PER_YEAR, type_=Float)
         )
 
     score = score.label('score')
 
     filter_score = (
         score
-        + func.cast(func.random()/random_normal * randomness, Float)
+        + func.cast(
+            func.random()
+            / bindparam('random_normal', type_=Float)
+            * bindparam('randomness', type_=Float),
+            Float
+        )
     ).label('filter_score')
 
     statement = select(Recording, score, filter_score)
 
-    if recording_length[f'{RECORDING_LENGTH}_{CONDITION}'] == RANGE:
+    if length_condition == RANGE:
         statement = statement.where(
-            recording_length[RANGE][0] <= Recording.length / 1_000
+            bindparam('length_min', type_=Float) <= recording_seconds
         )
-        if recording_length[RANGE][1] is not None:
+        if length_max:
             statement = statement.where(
-                Recording.length / 1_000 <= recording_length[RANGE][1]
+                recording_seconds <= bindparam('length_max', type_=Float)
             )
 
-    if recording_date[f'{RECORDING_DATE}_{CONDITION}'] == RANGE:
+    if date_condition == RANGE:
         statement = statement.where(
-                # Only year extract in cast because some rows only have years
-                recording_date[RANGE][0] <= func.cast(Recording.date, Date)
+            bindparam('date_min', type_=Integer) <= recording_year
         )
-        if recording_date[RANGE][1] is not None:
+        if date_max:
             statement = statement.where(
-                 func.cast(Recording.date, Date) <= recording_date[RANGE][1]
+                recording_year <= bindparam('date_max', type_=Integer)
+            )
+
+    if use_features:
+        if features is not None:
+            statement = statement.join(
+                features, features.c.recording_mbid == Recording.mbid
+            )
+    else:
+        if join_artist_tags:
+            statement = (statement
+                .join(artist_recording_association,
+                    Recording.mbid == artist_recording_association.c.recording_mbid
+                    )
+                .join(Artist, artist_recording_association.c.artist_mbid == Artist.mbid)
+                .join(ArtistTag, Artist.mbid == ArtistTag.artist_mbid)
             )
+        if join_recording_tags:
+            statement = statement.join(RecordingTag)
+
+    if unique_recordings:
+        if not use_features and join_artist_tags:
+            artist_mbid = artist_recording_association.c.artist_mbid
+        else:
+            artist_mbid = (
+                select(func.min(artist_recording_association.c.artist_mbid))
+                .where(artist_recording_association.c.recording_mbid == Recording.mbid)
+                .scalar_subquery()
+            )
+        statement = _diverse(
+            statement.with_only_columns(
+                Recording.mbid.label('recording_mbid'),
+                score,
+                filter_score,
+                artist_mbid.label('artist_mbid'),
+                maintain_column_froms=True
+            ),
+            max_per_artist
+        )
+
+    return statement.order_by(filter_score.desc()).limit(bindparam('limit', type_=Integer))
+
+def _tag_weight(tag_column, tag_type: str, slots: int):
+    """ Weight of tag_column's tag among the bound tags of tag_type, else 0 """
+    if not slots:
+        return 0.0
+    return case(
+        *[
+            (
+                tag_column == bindparam(f'{tag_type}_tag_{slot}', type_=String),
+                bindparam(f'{tag_type}_tag_weight_{slot}', type_=Float)
+            )
+            for slot in range(slots)
+        ],
+        else_=0.0
+    )
+
+def _diverse(candidates, max_per_artist: bool):
+    """
+    Select of Recording, score and filter_score keeping each recording's
+    best candidate row and, if max_per_artist, only the best max_per_artist
+    recordings of each artist, ranked with ROW_NUMBER().
+    """
+    candidates = candidates.subquery('candidates')
+    best_rows = select(
+        candidates,
+        func.row_number().over(
+            partition_by=candidates.c.recording_mbid,
+            order_by=candidates.c.filter_score.desc()
+        ).label('recording_rank')
+    ).subquery('best_rows')
+    recordings = (
+        select(best_rows)
+        .where(best_rows.c.recording_rank == 1)
+    )
 
-    if 'artist_tags' in weights:
-        statement = (statement
-            .join(artist_recording_association,
-                Recording.mbid == artist_recording_association.c.recording_mbid
+    if max_per_artist:
+        recordings = recordings.subquery('recordings')
+        recordings = select(
+            recordings,
+            func.row_number().over(
+                partition_by=recordings.c.artist_mbid,
+                order_by=recordings.c.filter_score.desc()
+            ).label('artist_rank')
+        ).subquery('artist_recordings')
+        recordings = (
+            select(recordings)
+            .where(recordings.c.artist_rank <= bindparam('max_per_artist', type_=Integer))
+        )
+
+    recordings = recordings.subquery('diverse')
+    return (
+        select(
+            Recording,
+            recordings.c.score.label('score'),
+            recordings.c.filter_score.label('filter_score')
+        )
+        .join(recordings, recordings.c.recording_mbid == Recording.mbid)
+    )
+
+def _feature_scores(artist_tag_slots: int, recording_tag_slots: int):
+    """
+    (recording_mbid, tag_score) of recordings with a bound tag, scored like
+    recommend() by their best artist tag and best recording tag.
+    None if there are no tags.
+    """
+    tag_score = 0.0
+    conditions = []
+    for tag_type, slots in (('artist', artist_tag_slots), ('recording', recording_tag_slots)):
+        if not slots:
+            continue
+        tags = [bindparam(f'{tag_type}_tag_{slot}', type_=String) for slot in range(slots)]
+        best_tag = func.max(case(
+            *[
+                (
+                    and_(
+                        RecordingFeature.source == tag_type,
+                        RecordingFeature.tag == tag
+                    ),
+                    bindparam(f'{tag_type}_tag_weight_{slot}', type_=Float)
                 )
-            .join(Artist, artist_recording_association.c.artist_mbid == Artist.mbid)
-            .join(ArtistTag, Artist.mbid == ArtistTag.artist_mbid)
-        )
-    if 'recording_tags' in weights:
-        statement = statement.join(RecordingTag)
-
-    limit = limit if limit < 100 else 100
-    statement = statement.order_by(filter_score.desc()).limit(limit)
-
-    results = session.execute(statement).fetchall()
-    row_mappings = [row._mapping for row in results]
-    recommendations = [
-        {
-            'filter_score': row_mapping['filter_score'],
-            'score': row_mapping['score'],
-            'recording': row_mapping['Recording'].__dict__,
-            'artists': [artist.__dict__ for artist in row_mapping['Recording'].artists],
-            'recording_tags': [tag.__dict__ for tag in row_mapping['Recording'].tags]
-        }
-        for row_mapping in row_mappings
-    ]
+                for slot, tag in enumerate(tags)
+            ],
+            else_=None
+        ))
+        tag_score += (
+            func.coalesce(best_tag, 0.0)
+            * bindparam(f'{tag_type}_tags_weight', type_=Float)
+        )
+        conditions.append(and_(
+            RecordingFeature.source == tag_type,
+            RecordingFeature.tag.in_(tags)
+        ))
 
-    return recommendations
+    if not conditions:
+        return None
+
+    return (
+        select(RecordingFeature.recording_mbid, tag_score.label('tag_score'))
+        .where(or_(*conditions))
+        .group_by(RecordingFeature.recording_mbid)
+        .subquery()
+    )
+
+def recommend_many(session, queries: list[dict]) -> list[list[dict]]:
+    """
+    Score many queries in one statement.
+
+    Each query is a dict of recommend() keyword arguments. Queries and their
+    weighted tags are passed as VALUES subqueries and joined against the tag
+    tables once, so the scan is shared by every query. Candidates for a query
+    are the recordings matching at least one of its weighted tags; each
+    recording appears at most once per query, scored by its best artist tag
+    and best recording tag like recommend()'s top row for it.
+    """
+    query_rows = []
+    query_tag_rows = []
+    for query_id, query in enumerate(queries):
+        if query.get('seed_artist'):
+            query = dict(query)
+            query['artist_tags'], query['weights'] = seed_artist_tags(
+                session,
+                query.pop('seed_artist'),
+                query.get('artist_tags', dict()),
+                query.get('weights', dict())
+            )
+        query_rows.append(query_params(query_id, **query))
+        weights = query.get('weights', dict())
+        for tag_type in ('artist', 'recording'):
+            if f'{tag_type}_tags' not in weights:
+                continue
+            type_weight = weights[f'{tag_type}_tags']
+            for tag, tag_weight in query.get(f'{tag_type}_tags', dict()).items():
+                query_tag_rows.append({
+                    'query_id': query_id,
+                    'tag_type': tag_type,
+                    'tag': tag,
+                    'weight': tag_weight * type_weight
+                })
+
+    results = [[] for _ in queries]
+    if not query_tag_rows:
+        return results
+
+    statement = _recommend_many_statement(
+        _values('recommend_query', _QUERY_COLUMNS, query_rows),
+        _values('recommend_query_tag', _QUERY_TAG_COLUMNS, query_tag_rows)
+    )
+    for row in session.execute(statement).fetchall():
+        results[row.query_id].append(recommendation_dict(row._mapping))
+
+    return results
+
+def query_params(
+        query_id: int,
+        artist_tags: dict[str, float] = dict(),
+        recording_tags: dict[str, float] = dict(),
+        weights: dict[str, float] = dict(),
+        recording_length: dict = dict(),
+        recording_date: dict = dict(),
+        recording_status: str = '',
+        randomness: float = 1.,
+        random_normal: float = 2.**64,
+        limit: int = 100,
+        seed_artist: str = '',
+        use_features: bool = False,
+        unique_recordings: bool = False,
+        max_per_artist: int | None = None
+    ) -> dict:
+    """
+    Flatten recommend() keyword arguments into one row of parameters.
+
+    Tags are not included. seed_artist must already have been resolved
+    with seed_artist_tags, which needs a session, and raises ValueError
+    otherwise. use_features and unique_recordings are accepted but ignored:
+    callers (recommend_many, TagIndex, ShardedRecommender) already score by
+    best artist and recording tag like use_features and return each
+    recording at most once. They do not cap artists, so max_per_artist
+    raises ValueError rather than return results breaking the cap.
+    """
+    if seed_artist:
+        raise ValueError(
+            'seed_artist must be resolved with seed_artist_tags first'
+        )
+    if max_per_artist is not None:
+        raise ValueError('max_per_artist is only supported by recommend()')
+
+    params = {
+        'query_id': query_id,
+        'length_min': None,
+        'length_max': None,
+        'length_center': None,
+        POINTS_PER_SECOND: None,
+        'date_min': None,
+        'date_max': None,
+        'date_center': None,
+        POINTS_PER_YEAR: None,
+        'randomness': randomness,
+        'random_normal': random_normal,
+        'limit': limit if limit < 100 else 100
+    }
+
+    length_condition = recording_length.get(f'{RECORDING_LENGTH}_{CONDITION}')
+    if length_condition == RANGE:
+        params['length_min'], params['length_max'] = recording_length[RANGE]
+    elif length_condition == CENTER:
+        params['length_center'] = recording_length[CENTER]
+        params[POINTS_PER_SECOND] = recording_length[POINTS_PER_SECOND]
+
+    date_condition = recording_date.get(f'{RECORDING_DATE}_{CONDITION}')
+    if date_condition == RANGE:
+        params['date_min'], params['date_max'] = recording_date[RANGE]
+    elif date_condition == CENTER:
+        params['date_center'] = recording_date[CENTER]
+        params[POINTS_PER_YEAR] = recording_date[POINTS_PER_YEAR]
+
+    return params
+
+def seed_artist_tags(
+        session,
+        seed_artist: str,
+        artist_tags: dict[str, float],
+        weights: dict[str, float]
+    ) -> tuple[dict[str, float], dict[str, float]]:
+    """
+    Add the stored tags of the artist best matching seed_artist to artist_tags.
+
+    Explicit artist_tags take precedence over the seed artist's, and the
+    artist tags weight defaults to 1 so the seeded tags count.
+    """
+    artist_tags = {**artist_tag_weights(session, seed_artist), **artist_tags}
+    weights = {'artist_tags': 1.0, **weights}
+    return artist_tags, weights
+
+def _values(name: str, columns: list[tuple], rows: list[dict]):
+    """
+    Subquery over a VALUES list of rows.
+
+    Used instead of temporary tables so recommend_many also runs on
+    read-only connections. Columns are cast since a column of only NULLs
+    would otherwise have no type on PostgreSQL.
+    """
+    params = dict()
+    values = []
+    for row_n, row in enumerate(rows):
+        keys = [f'{name}_{row_n}_{column_n}' for column_n in range(len(columns))]
+        params.update(
+            {key: row[column_name] for key, (column_name, _) in zip(keys, columns)}
+        )
+        values.append('(' + ', '.join(f':{key}' for key in keys) + ')')
+
+    type_names = {Integer: 'INTEGER', Float: 'FLOAT', String: 'VARCHAR'}
+    select_list = ', '.join(
+        f'CAST(column{column_n + 1} AS {type_names[column_type]}) AS "{column_name}"'
+        for column_n, (column_name, column_type) in enumerate(columns)
+    )
+    return (
+        text(f"SELECT {select_list} FROM (VALUES {', '.join(values)}) AS {name}_values")
+        .bindparams(**params)
+        .columns(*[column(column_name, column_type) for column_name, column_type in columns])
+        .subquery(name)
+    )
+
+def _recommend_many_statement(query_values, query_tag_values):
+    query = query_values.c
+    query_tag = query_tag_values.c
+
+    # One row per matching (query, recording, tag), best match kept per side
+    matches = union_all(
+        select(
+            query_tag.query_id,
+            artist_recording_association.c.recording_mbid,
+            query_tag.weight.label('artist_score'),
+            null().label('recording_score')
+        )
+        .select_from(query_tag_values)
+        .join(ArtistTag, ArtistTag.tag == query_tag.tag)
+        .join(artist_recording_association,
+            ArtistTag.artist_mbid == artist_recording_association.c.artist_mbid
+            )
+        .where(query_tag.tag_type == 'artist'),
+        select(
+            query_tag.query_id,
+            RecordingTag.recording_mbid,
+            null().label('artist_score'),
+            query_tag.weight.label('recording_score')
+        )
+        .select_from(query_tag_values)
+        .join(RecordingTag, RecordingTag.tag == query_tag.tag)
+        .where(query_tag.tag_type == 'recording')
+    ).subquery()
+
+    tag_scores = (
+        select(
+            matches.c.query_id,
+            matches.c.recording_mbid,
+            (
+                func.coalesce(func.max(matches.c.artist_score), 0.0)
+                + func.coalesce(func.max(matches.c.recording_score), 0.0)
+            ).label('tag_score'),
+            # Drawn per group so the ranking and the output see the same value
+            func.random().label('noise')
+        )
+        .group_by(matches.c.query_id, matches.c.recording_mbid)
+        .subquery()
+    )
+
+    # Only year extract in cast because some rows only have years
+    recording_year = func.cast(Recording.date, Date)
+    recording_seconds = Recording.length / 1_000
+
+    score = (
+        func.cast(tag_scores.c.tag_score, Float)
+        - case(
+            (query.length_center.is_(None), 0.0),
+            else_=(
+                func.abs(recording_seconds - query.length_center)
+                * query.points_per_second
+            )
+        )
+        - case(
+            (query.date_center.is_(None), 0.0),
+            else_=(
+                func.abs(recording_year - query.date_center)
+                * query.points_per_year
+            )
+        )
+    ).label('score')
+
+    filter_score = (
+        score
+        + func.cast(tag_scores.c.noise / query.random_normal * query.randomness, Float)
+    ).label('filter_score')
+
+    ranked = (
+        select(
+            tag_scores.c.query_id,
+            tag_scores.c.recording_mbid,
+            score,
+            filter_score,
+            func.row_number().over(
+                partition_by=tag_scores.c.query_id,
+                order_by=filter_score.desc()
+            ).label('rank'),
+            query.limit
+        )
+        .join(query_values, query.query_id == tag_scores.c.query_id)
+        .join(Recording, Recording.mbid == tag_scores.c.recording_mbid)
+        .where(or_(query.length_min.is_(None), query.length_min <= recording_seconds))
+        .where(or_(query.length_max.is_(None), recording_seconds <= query.length_max))
+        .where(or_(query.date_min.is_(None), query.date_min <= recording_year))
+        .where(or_(query.date_max.is_(None), recording_year <= query.date_max))
+        .subquery()
+    )
+
+    return (
+        select(ranked.c.query_id, Recording, ranked.c.score, ranked.c.filter_score)
+        .join(Recording, Recording.mbid == ranked.c.recording_mbid)
+        .where(ranked.c.rank <= ranked.c.limit)
+        .order_by(ranked.c.query_id, ranked.c.rank)
+    )
+
+def recommendation_dict(row_mapping: RowMapping) -> dict:
+    return {
+        'filter_score': row_mapping['filter_score'],
+        'score': row_mapping['score'],
+        'recording': row_mapping['Recording'].__dict__,
+        'artists': [artist.__dict__ for artist in row_mapping['Recording'].artists],
+        'recording_tags': [tag.__dict__ for tag in row_mapping['Recording'].tags]
+    }
 
 def get_tag_options(session, tag_type: str) -> list[str]:
     if tag_type == 'artist':
@@ -131,3 +709,7 @@ def get_tag_options(session, tag_type: str) -> list[str]:
         table = RecordingTag
     results = session.execute(select(table.tag).distinct()).fetchall()
     return [result[0] for result in results]
+
+
+if __name__ == '__main__':
+    main()
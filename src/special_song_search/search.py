@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import re
+
+from sqlalchemy import select
+from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy import literal_column
+
+from special_song_search.models import (
+    Artist, ArtistTag,
+    Recording
+)
+
+
+# Columns indexed per table, see database.create_search_index
+SEARCH_COLUMNS = {
+    'recording': ('title',),
+    'artist': ('name', 'disambiguation')
+}
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    from special_song_search.database import init_db
+    parser = ArgumentParser()
+    parser.add_argument('search_type', type=str, choices=['artist', 'recording'])
+    parser.add_argument('query', type=str)
+    parser.add_argument('--limit', dest='limit', type=int, default=10)
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR"
+                             )
+                        )
+    args = parser.parse_args()
+
+    _, Session = init_db(args.database)
+    with Session() as session:
+        if args.search_type == 'artist':
+            for result in search_artists(session, args.query, args.limit):
+                print(f"{result['score']:.3f}\t{result['artist']['name']}")
+        else:
+            for result in search_recordings(session, args.query, args.limit):
+                print(f"{result['score']:.3f}\t{result['recording']['title']}")
+
+    return
+
+def search_recordings(session, query: str, limit: int = 10) -> list[dict]:
+    """ Recordings whose title matches query, best match first """
+    return [
+        {'score': score, 'recording': recording.__dict__}
+        for recording, score in _search(session, Recording, query, limit)
+    ]
+
+def search_artists(session, query: str, limit: int = 10) -> list[dict]:
+    """ Artists whose name or disambiguation matches query, best match first """
+    return [
+        {'score': score, 'artist': artist.__dict__}
+        for artist, score in _search(session, Artist, query, limit)
+    ]
+
+def artist_tag_weights(session, artist_name: str) -> dict[str, float]:
+    """
+    Tag weights of the artist best matching artist_name.
+
+    Weights are the artist's tag votes relative to its most voted tag, so
+    they fall in (0, 1]. Empty if no artist matches.
+    """
+    artists = search_artists(session, artist_name, limit=1)
+    if not artists:
+        return dict()
+
+    tags = session.execute(
+        select(ArtistTag.tag, ArtistTag.tag_votes)
+        .where(ArtistTag.artist_mbid == artists[0]['artist']['mbid'])
+    ).fetchall()
+    max_votes = max((tag.tag_votes for tag in tags), default=0)
+    if max_votes <= 0:
+        return {tag.tag: 1.0 for tag in tags}
+
+    return {tag.tag: max(tag.tag_votes, 0) / max_votes for tag in tags}
+
+def search_document(table: str) -> str:
+    """ PostgreSQL tsvector expression indexed for table """
+    document = " || ' ' || ".join(
+        f"coalesce({column}, '')" for column in SEARCH_COLUMNS[table]
+    )
+    return f"to_tsvector('simple', {document})"
+
+def _search(session, model, query: str, limit: int) -> list[tuple]:
+    table = model.__tablename__
+    dialect = session.get_bind().dialect.name
+    words = re.findall(r'\w+', query)
+    if not words:
+        return []
+
+    if dialect == 'sqlite':
+        # Quoted so user input is never parsed as FTS5 query syntax
+        match = ' '.join(f'"{word}"' for word in words)
+        results = session.execute(
+            text(
+                f'SELECT mbid, -bm25({table}_search) AS score '
+                f'FROM {table}_search '
+                f'WHERE {table}_search MATCH :match '
+                f'ORDER BY bm25({table}_search) LIMIT :limit'
+            ),
+            {'match': match, 'limit': limit}
+        ).fetchall()
+
+    elif dialect == 'postgresql':
+        document = literal_column(search_document(table))
+        ts_query = func.plainto_tsquery(literal_column("'simple'"), ' '.join(words))
+        score = func.ts_rank(document, ts_query).label('score')
+        results = session.execute(
+            select(model.mbid, score)
+            .where(document.op('@@')(ts_query))
+            .order_by(score.desc())
+            .limit(limit)
+        ).fetchall()
+
+    else:
+        raise ValueError(f'Full-text search is not set up for {dialect}')
+
+    scores = {mbid: score for mbid, score in results}
+    rows = session.execute(
+        select(model).where(model.mbid.in_(scores))
+    ).scalars().all()
+    rows.sort(key=lambda row: scores[row.mbid], reverse=True)
+
+    return [(row, scores[row.mbid]) for row in rows]
+
+
+if __name__ == '__main__':
+    main()
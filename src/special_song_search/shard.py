@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import heapq
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from special_song_search.recommend import query_params
+from special_song_search.snapshot import load_snapshot, NO_LENGTH, NO_YEAR
+
+
+# Worker process state, set by _init_worker
+_snapshot = None
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('snapshot', type=str,
+                        help='Snapshot directory, or directory of snapshots')
+    parser.add_argument('queries', type=str,
+                        help=('JSONL file of recommend() keyword arguments, '
+                              +"one query per line, '-' for stdin"
+                             )
+                       )
+    parser.add_argument('--shards', dest='n_shards', type=int,
+                        default=os.cpu_count(), help='Number of shards')
+    parser.add_argument('--processes', dest='processes', type=int, default=None,
+                        help='Worker processes, defaults to number of shards')
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help='Seed for the randomness term')
+    args = parser.parse_args()
+
+    if args.queries == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(args.queries) as queries_file:
+            lines = queries_file.readlines()
+
+    with ShardedRecommender(args.snapshot, args.n_shards, args.processes) as recommender:
+        for query_n, line in enumerate(lines):
+            if not line.strip():
+                continue
+            query = json.loads(line)
+            query_id = query.pop('id', query_n)
+            print(json.dumps({
+                'id': query_id,
+                'recommendations': recommender.recommend(seed=args.seed, **query)
+            }))
+
+    return
+
+
+class ShardedRecommender:
+    """
+    Score recommend() queries against a snapshot with a pool of processes.
+
+    The snapshot is split into n_shards contiguous ranges of recordings. As
+    recordings are sorted by mbid, which MusicBrainz generates randomly, each
+    range is a uniform hash partition of the catalog. Every worker memory-maps
+    the same snapshot, scores whole shards and returns its shard's top-k;
+    the parent merges them.
+    """
+
+    def __init__(self, snapshot_path: str, n_shards: int, processes: int | None = None):
+        self.snapshot = load_snapshot(snapshot_path)
+        self.n_shards = max(1, n_shards)
+        self.bounds = np.linspace(
+            0, self.snapshot.n_recordings, self.n_shards + 1
+        ).astype(np.int64)
+        self.pool = ProcessPoolExecutor(
+            max_workers=processes or self.n_shards,
+            initializer=_init_worker,
+            initargs=(self.snapshot.path,)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self.pool.shutdown()
+
+    def recommend(self, seed: int | None = None, **query) -> list[dict]:
+        """
+        Top recordings for one query, given as recommend() keyword arguments.
+
+        Scores follow recommend(): a recording's best matching artist tag and
+        best matching recording tag, less the length and date penalties, plus
+        a random term. The random term of shard i is drawn from
+        default_rng([seed, i]), so a given seed always gives the same result.
+        Snapshots have no session to look up seed_artist with, so it raises
+        ValueError; pass the tags from seed_artist_tags instead.
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        params = query_params(0, **query)
+        tag_weights = _tag_weights(query)
+        # Shared by every shard, so computed once here
+        matched_artists = None
+        if 'artist' in tag_weights:
+            matched_artists = artist_matches(self.snapshot, tag_weights['artist'])
+
+        futures = [
+            self.pool.submit(
+                _score_shard_in_worker,
+                params,
+                tag_weights,
+                int(self.bounds[shard]),
+                int(self.bounds[shard + 1]),
+                [seed, shard],
+                matched_artists
+            )
+            for shard in range(self.n_shards)
+        ]
+        shard_results = [future.result() for future in futures]
+
+        merged = heapq.merge(*shard_results, reverse=True)
+        return [
+            {
+                'filter_score': filter_score,
+                'score': score,
+                'recording_mbid': self.snapshot.recording_mbid[position].decode()
+            }
+            for filter_score, score, position in islice(merged, params['limit'])
+        ]
+
+def recommend_sharded(
+        snapshot_path: str,
+        n_shards: int,
+        processes: int | None = None,
+        seed: int | None = None,
+        **query
+    ) -> list[dict]:
+    """ One-off ShardedRecommender.recommend, see ShardedRecommender """
+    with ShardedRecommender(snapshot_path, n_shards, processes) as recommender:
+        return recommender.recommend(seed=seed, **query)
+
+def score_shard(
+        snapshot,
+        params: dict,
+        tag_weights: dict[str, dict[str, float]],
+        start: int,
+        stop: int,
+        seed: list[int],
+        matched_artists: tuple[np.ndarray, np.ndarray] | None = None
+    ) -> list[tuple[float, float, int]]:
+    """
+    Score recordings start:stop of snapshot.
+
+    matched_artists is artist_matches() for the query's artist tags,
+    computed here if not given. Returns the shard's top params['limit']
+    (filter_score, score, position) tuples, best first.
+    """
+    n_rows = stop - start
+    positions = np.arange(start, stop)
+    score = np.zeros(n_rows)
+    keep = np.ones(n_rows, dtype=bool)
+
+    if 'artist' in tag_weights:
+        if matched_artists is None:
+            matched_artists = artist_matches(snapshot, tag_weights['artist'])
+        # Best tag of each of the shard's artists, then best artist per recording
+        indptr, indices = _shard_rows(
+            snapshot.recording_artist_indptr,
+            snapshot.recording_artist_indices,
+            start, stop
+        )
+        recording_artist_best = _row_max(
+            indptr, _artist_best(snapshot, matched_artists, indices), n_rows
+        )
+        keep &= recording_artist_best > -np.inf
+        score += np.where(keep, recording_artist_best, 0.)
+
+    if 'recording' in tag_weights:
+        indptr, indices = _shard_rows(
+            snapshot.recording_tag_indptr,
+            snapshot.recording_tag_indices,
+            start, stop
+        )
+        recording_best = _row_max(
+            indptr,
+            _vocabulary_weights(snapshot, 'recording', tag_weights['recording'])
+            [indices],
+            n_rows
+        )
+        keep &= recording_best > -np.inf
+        score += np.where(keep, recording_best, 0.)
+
+    length = np.asarray(snapshot.recording_length[start:stop])
+    seconds = length / 1_000
+    if params['length_center'] is not None:
+        keep &= length != NO_LENGTH
+        score -= (
+            np.abs(seconds - params['length_center'])
+            * params['points_per_second']
+        )
+    if params['length_min'] is not None:
+        keep &= (length != NO_LENGTH) & (params['length_min'] <= seconds)
+    if params['length_max'] is not None:
+        keep &= (length != NO_LENGTH) & (seconds <= params['length_max'])
+
+    year = np.asarray(snapshot.recording_year[start:stop])
+    if params['date_center'] is not None:
+        keep &= year != NO_YEAR
+        score -= np.abs(year - params['date_center']) * params['points_per_year']
+    if params['date_min'] is not None:
+        keep &= (year != NO_YEAR) & (params['date_min'] <= year)
+    if params['date_max'] is not None:
+        keep &= (year != NO_YEAR) & (year <= params['date_max'])
+
+    # Same range as recommend()'s random() / random_normal
+    noise = np.random.default_rng(seed).uniform(-1., 1., n_rows)
+    filter_score = (
+        score
+        + noise * (2.**63 / params['random_normal']) * params['randomness']
+    )
+
+    candidates = np.flatnonzero(keep)
+    limit = params['limit']
+    if len(candidates) > limit:
+        top = np.argpartition(-filter_score[candidates], limit - 1)[:limit]
+        candidates = candidates[top]
+    candidates = candidates[np.argsort(-filter_score[candidates])]
+
+    return [
+        (float(filter_score[row]), float(score[row]), int(positions[row]))
+        for row in candidates
+    ]
+
+def artist_matches(snapshot, tag_weights: dict[str, float]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (positions, best tag weights) of the artists whose best tag weight is
+    not 0, positions ascending. Other artists score 0 if they have any tag.
+    """
+    artist_best = _row_max(
+        np.asarray(snapshot.artist_tag_indptr),
+        _vocabulary_weights(snapshot, 'artist', tag_weights)
+        [snapshot.artist_tag_indices],
+        len(snapshot.artist_mbid)
+    )
+    positions = np.flatnonzero((artist_best != 0.) & (artist_best > -np.inf))
+    return positions, artist_best[positions]
+
+def _artist_best(snapshot, matched_artists, artists: np.ndarray) -> np.ndarray:
+    """ Best tag weight of each artist position in artists, -inf if untagged """
+    tag_indptr = snapshot.artist_tag_indptr
+    best = np.where(tag_indptr[artists + 1] > tag_indptr[artists], 0., -np.inf)
+    positions, weights = matched_artists
+    if positions.size:
+        found = np.minimum(np.searchsorted(positions, artists), positions.size - 1)
+        matched = positions[found] == artists
+        best[matched] = weights[found[matched]]
+    return best
+
+def _tag_weights(query: dict) -> dict[str, dict[str, float]]:
+    """ Query tag weights scaled by their type weight, per weighted type """
+    weights = query.get('weights', dict())
+    return {
+        tag_type: {
+            tag: tag_weight * weights[f'{tag_type}_tags']
+            for tag, tag_weight in query.get(f'{tag_type}_tags', dict()).items()
+        }
+        for tag_type in ('artist', 'recording')
+        if f'{tag_type}_tags' in weights
+    }
+
+def _vocabulary_weights(snapshot, tag_type: str, tag_weights: dict[str, float]) -> np.ndarray:
+    """ Weight of every tag in the vocabulary, 0 for tags not in the query """
+    vocabulary_weights = np.zeros(len(getattr(snapshot, f'{tag_type}_tag_names')))
+    tags = list(tag_weights)
+    for tag, position in zip(tags, snapshot.tag_positions(tag_type, tags)):
+        if position != -1:
+            vocabulary_weights[position] = tag_weights[tag]
+    return vocabulary_weights
+
+def _shard_rows(indptr, indices, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+    """ CSR rows start:stop re-based to start at 0 """
+    shard_indptr = np.asarray(indptr[start:stop + 1])
+    return (
+        shard_indptr - shard_indptr[0],
+        np.asarray(indices[shard_indptr[0]:shard_indptr[-1]])
+    )
+
+def _row_max(indptr: np.ndarray, values: np.ndarray, n_rows: int) -> np.ndarray:
+    """ Max of values per CSR row, -inf for empty rows """
+    row_max = np.full(n_rows, -np.inf)
+    nonempty = indptr[1:] > indptr[:-1]
+    if values.size:
+        row_max[nonempty] = np.maximum.reduceat(values, indptr[:-1][nonempty])
+    return row_max
+
+def _init_worker(snapshot_path: str) -> None:
+    global _snapshot
+    _snapshot = load_snapshot(snapshot_path)
+
+def _score_shard_in_worker(*args) -> list[tuple[float, float, int]]:
+    return score_shard(_snapshot, *args)
+
+
+if __name__ == '__main__':
+    main()
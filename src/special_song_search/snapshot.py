@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+import json
+import os
+import shutil
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import select
+
+from special_song_search.database import (
+    init_db,
+    catalog_generation,
+    read_transaction
+)
+from special_song_search.models import (
+    artist_recording_association,
+    Artist, ArtistTag,
+    Recording, RecordingTag
+)
+
+
+SNAPSHOT_FORMAT = 1
+MANIFEST = 'manifest.json'
+
+# Null sentinels for integer columns
+NO_LENGTH = -1
+NO_YEAR = 0
+
+
+def main() -> None:
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('directory', type=str,
+                        help='Directory in which to write versioned snapshots')
+    parser.add_argument('--database', dest='database', type=str, default='',
+                        help=('Database connection string\n'
+                              +'Empty string creates/uses sqlite test.db\n'
+                              +"'main' creates/uses $DATABASE_STR"
+                             )
+                        )
+    parser.add_argument('-v', dest='verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    _, Session = init_db(args.database, verbose=args.verbose)
+    with Session() as session:
+        print(export_snapshot(session, args.directory, verbose=args.verbose))
+
+    return
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """
+    Columnar, read-only view of the catalog.
+
+    Recordings and artists are sorted by mbid and referred to by their
+    position. Tags are CSR matrices: the tags of recording i are
+    recording_tag_indices[recording_tag_indptr[i]:recording_tag_indptr[i + 1]]
+    (positions in recording_tag_names) with votes in recording_tag_data.
+    """
+    path: str
+    generation: str
+    manifest: dict
+    recording_mbid: np.ndarray
+    recording_length: np.ndarray
+    recording_year: np.ndarray
+    recording_rating: np.ndarray
+    recording_rating_votes: np.ndarray
+    recording_tag_names: np.ndarray
+    recording_tag_indptr: np.ndarray
+    recording_tag_indices: np.ndarray
+    recording_tag_data: np.ndarray
+    recording_artist_indptr: np.ndarray
+    recording_artist_indices: np.ndarray
+    artist_mbid: np.ndarray
+    artist_tag_names: np.ndarray
+    artist_tag_indptr: np.ndarray
+    artist_tag_indices: np.ndarray
+    artist_tag_data: np.ndarray
+
+    @property
+    def n_recordings(self) -> int:
+        return len(self.recording_mbid)
+
+    def recording_positions(self, mbids: list[str]) -> np.ndarray:
+        """ Positions of mbids in recording_mbid, -1 where missing """
+        return _positions(self.recording_mbid, mbids)
+
+    def tag_positions(self, tag_type: str, tags: list[str]) -> np.ndarray:
+        """ Positions of tags in the tag_type's vocabulary, -1 where missing """
+        return _positions(getattr(self, f'{tag_type}_tag_names'), tags)
+
+
+def export_snapshot(session, directory: str, verbose: bool = False) -> str:
+    """
+    Write the catalog to directory/<generation> and return that path.
+
+    The snapshot is built in a temporary directory and renamed into place, so
+    readers never see a partial snapshot. An existing snapshot of the same
+    generation is reused. The generation and the catalog are read in one
+    read_transaction, so a concurrent crawl cannot make them disagree.
+    """
+    with read_transaction(session) as reader:
+        generation = catalog_generation(reader)
+        path = os.path.join(directory, generation)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            if verbose:
+                print(f'Snapshot {generation} already exists')
+            return path
+
+        if verbose:
+            print(f'Exporting snapshot {generation}')
+
+        arrays = _catalog_arrays(reader)
+    n_recordings = len(arrays['recording_mbid'])
+    n_artists = len(arrays['artist_mbid'])
+
+    os.makedirs(directory, exist_ok=True)
+    build_path = f'{path}.tmp-{os.getpid()}'
+    os.makedirs(build_path)
+    try:
+        for name, values in arrays.items():
+            np.save(os.path.join(build_path, f'{name}.npy'), values)
+        manifest = {
+            'format': SNAPSHOT_FORMAT,
+            'generation': generation,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'n_recordings': n_recordings,
+            'n_artists': n_artists,
+            'arrays': sorted(arrays)
+        }
+        with open(os.path.join(build_path, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.rename(build_path, path)
+    except OSError:
+        shutil.rmtree(build_path, ignore_errors=True)
+        # Another exporter finished the same generation first
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            return path
+        raise
+
+    if verbose:
+        print(f'Exported {n_recordings} recordings to {path}')
+
+    return path
+
+def load_snapshot(path: str) -> Snapshot:
+    """
+    Memory-map a snapshot.
+
+    path is either a snapshot directory or a directory of snapshots, in
+    which case the most recently created one is loaded. Arrays are opened
+    read-only with mmap, so every process loading the same snapshot shares
+    one copy in the page cache.
+    """
+    if not os.path.exists(os.path.join(path, MANIFEST)):
+        path = latest_snapshot(path)
+
+    with open(os.path.join(path, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest['format'] != SNAPSHOT_FORMAT:
+        raise ValueError(
+            f"Snapshot format {manifest['format']} is not {SNAPSHOT_FORMAT}"
+        )
+
+    arrays = {
+        name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        for name in manifest['arrays']
+    }
+
+    return Snapshot(
+        path=path,
+        generation=manifest['generation'],
+        manifest=manifest,
+        **arrays
+    )
+
+def latest_snapshot(directory: str) -> str:
+    """ Path of the most recently created snapshot in directory """
+    manifests = []
+    for name in os.listdir(directory):
+        # Exports in progress hold a manifest just before being renamed
+        if '.tmp-' in name:
+            continue
+        manifest_path = os.path.join(directory, name, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifests.append(
+                    (json.load(manifest_file)['created'], os.path.join(directory, name))
+                )
+    if not manifests:
+        raise FileNotFoundError(f'No snapshots in {directory}')
+    return max(manifests)[1]
+
+def _catalog_arrays(session) -> dict[str, np.ndarray]:
+    """ Snapshot arrays of the catalog, by name """
+    arrays = {}
+
+    recordings = session.execute(
+        select(
+            Recording.mbid,
+            Recording.length,
+            Recording.date,
+            Recording.rating,
+            Recording.rating_votes
+        )
+    ).fetchall()
+    # Sorted here rather than in SQL so the order is bytewise on any backend
+    recordings.sort(key=lambda recording: recording.mbid)
+    recording_mbids = [recording.mbid for recording in recordings]
+    arrays['recording_mbid'] = _string_array(recording_mbids)
+    arrays['recording_length'] = np.array(
+        [
+            NO_LENGTH if recording.length is None else recording.length
+            for recording in recordings
+        ],
+        dtype=np.int64
+    )
+    arrays['recording_year'] = np.array(
+        [parse_year(recording.date) for recording in recordings],
+        dtype=np.int16
+    )
+    arrays['recording_rating'] = np.array(
+        [
+            np.nan if recording.rating is None else recording.rating
+            for recording in recordings
+        ],
+        dtype=np.float32
+    )
+    arrays['recording_rating_votes'] = np.array(
+        [recording.rating_votes or 0 for recording in recordings],
+        dtype=np.int32
+    )
+    del recordings
+
+    artist_mbids = sorted(session.execute(select(Artist.mbid)).scalars())
+    arrays['artist_mbid'] = _string_array(artist_mbids)
+
+    recording_positions = {mbid: n for n, mbid in enumerate(recording_mbids)}
+    artist_positions = {mbid: n for n, mbid in enumerate(artist_mbids)}
+
+    for tag_type, table, owner_column, owner_positions in (
+            ('recording', RecordingTag, RecordingTag.recording_mbid,
+             recording_positions),
+            ('artist', ArtistTag, ArtistTag.artist_mbid, artist_positions)
+        ):
+        tag_names = sorted(
+            session.execute(select(table.tag).distinct()).scalars()
+        )
+        tag_positions = {tag: n for n, tag in enumerate(tag_names)}
+        arrays[f'{tag_type}_tag_names'] = _string_array(tag_names)
+
+        rows = session.execute(select(owner_column, table.tag, table.tag_votes))
+        (
+            arrays[f'{tag_type}_tag_indptr'],
+            arrays[f'{tag_type}_tag_indices'],
+            arrays[f'{tag_type}_tag_data']
+        ) = _csr(
+            (
+                (owner_positions[owner], tag_positions[tag], votes)
+                for owner, tag, votes in rows
+            ),
+            len(owner_positions)
+        )
+
+    rows = session.execute(
+        select(
+            artist_recording_association.c.recording_mbid,
+            artist_recording_association.c.artist_mbid
+        )
+    )
+    (
+        arrays['recording_artist_indptr'],
+        arrays['recording_artist_indices'],
+        _
+    ) = _csr(
+        (
+            (recording_positions[recording], artist_positions[artist], 1)
+            for recording, artist in rows
+        ),
+        len(recording_positions)
+    )
+
+    return arrays
+
+def _csr(entries, n_rows: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Build CSR arrays from (row, column, value) entries in any order """
+    rows = array('i')
+    indices = array('i')
+    data = array('i')
+    for row, column, value in entries:
+        rows.append(row)
+        indices.append(column)
+        data.append(value)
+
+    rows = np.frombuffer(rows, dtype=np.int32)
+    indices = np.frombuffer(indices, dtype=np.int32)
+    data = np.frombuffer(data, dtype=np.int32)
+    order = np.lexsort((indices, rows))
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+
+    return indptr, indices[order], data[order]
+
+def _string_array(strings: list[str]) -> np.ndarray:
+    # Fixed-width bytes so the array can be memory-mapped
+    return np.array([string.encode() for string in strings], dtype=np.bytes_)
+
+def _positions(sorted_strings: np.ndarray, strings: list[str]) -> np.ndarray:
+    if len(sorted_strings) == 0:
+        return np.full(len(strings), -1, dtype=np.int64)
+    keys = _string_array(list(strings))
+    positions = np.searchsorted(sorted_strings, keys)
+    positions[positions == len(sorted_strings)] = 0
+    found = sorted_strings[positions] == keys
+    return np.where(found, positions, -1)
+
+def parse_year(date: str | None) -> int:
+    """ Year of a MusicBrainz date, NO_YEAR if it has none """
+    if date and date[:4].isdigit():
+        return int(date[:4])
+    return NO_YEAR
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import random
+import uuid
+
+import pytest
+from sqlalchemy import insert
+
+from special_song_search.database import init_db
+from special_song_search.features import rebuild_recording_features
+from special_song_search.models import (
+    artist_recording_association,
+    Artist, ArtistTag,
+    Recording, RecordingTag
+)
+
+
+TAGS = [f'tag{n}' for n in range(12)]
+
+
+@pytest.fixture(scope='session')
+def session(tmp_path_factory):
+    """ Small random catalog, one artist per recording """
+    path = tmp_path_factory.mktemp('db') / 'catalog.db'
+    _, Session = init_db(f'sqlite:///{path}')
+    rng = random.Random(0)
+
+    def mbid():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    artists = [{'mbid': mbid(), 'name': f'Artist {n}', 'country': 'US'} for n in range(30)]
+    recordings = [
+        {
+            'mbid': mbid(),
+            'title': f'Song {n}',
+            'length': rng.randint(60_000, 600_000),
+            'date': f'{rng.randint(1950, 2023)}-01-01'
+        }
+        for n in range(400)
+    ]
+
+    with Session() as session:
+        session.execute(insert(Artist), artists)
+        session.execute(insert(ArtistTag), [
+            {'artist_mbid': artist['mbid'], 'tag': tag, 'tag_votes': rng.randint(1, 9)}
+            for artist in artists
+            for tag in rng.sample(TAGS, rng.randint(1, 4))
+        ])
+        session.execute(insert(Recording), recordings)
+        session.execute(insert(RecordingTag), [
+            {'recording_mbid': recording['mbid'], 'tag': tag, 'tag_votes': rng.randint(1, 9)}
+            for recording in recordings
+            for tag in rng.sample(TAGS, rng.randint(1, 4))
+        ])
+        session.execute(insert(artist_recording_association), [
+            {'artist_mbid': rng.choice(artists)['mbid'], 'recording_mbid': recording['mbid']}
+            for recording in recordings
+        ])
+        rebuild_recording_features(session)
+        session.commit()
+
+        yield session
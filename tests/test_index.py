@@ -0,0 +1,86 @@
+import random
+from array import array
+
+import pytest
+
+from special_song_search.index import PostingList, TagIndex
+
+
+def brute_force(terms, accept=None):
+    """ Every accepted recording's summed score, best first """
+    scores = dict()
+    for posting, query_weight in terms:
+        for id_, weight in zip(posting.ids, posting.weights):
+            scores[id_] = scores.get(id_, 0.0) + query_weight * weight
+    return sorted(
+        (
+            (score, id_) for id_, score in scores.items()
+            if accept is None or accept(id_)
+        ),
+        reverse=True
+    )
+
+def random_terms(rng, n_recordings, sizes):
+    return [
+        (
+            # Mostly 1.0, like weights relative to each owner's top tag
+            PostingList({
+                id_: rng.choice([1.0, rng.random()])
+                for id_ in rng.sample(range(n_recordings), size)
+            }),
+            rng.choice([0.5, 1.0, 2.0, 3.0])
+        )
+        for size in sizes
+    ]
+
+def empty_index():
+    return TagIndex([], array('i'), array('h'), dict())
+
+
+@pytest.mark.parametrize('seed', range(10))
+@pytest.mark.parametrize('k', [1, 10, 50])
+@pytest.mark.parametrize('filtered', [False, True])
+def test_top_k_matches_brute_force(seed, k, filtered):
+    rng = random.Random(seed)
+    terms = random_terms(rng, 5_000, [rng.randint(1, 3_000) for _ in range(rng.randint(1, 5))])
+    accept = (lambda id_: id_ % 3 != 0) if filtered else None
+
+    expected = brute_force(terms, accept)[:k]
+    result = empty_index().top_k(terms, k, accept)
+
+    assert [score for score, _ in result] == pytest.approx(
+        [score for score, _ in expected]
+    )
+    if accept is not None:
+        assert all(accept(id_) for _, id_ in result)
+
+def test_top_k_independent_of_term_order():
+    rng = random.Random(0)
+    terms = random_terms(rng, 20_000, [15_000, 3_000, 500, 80])
+    for term in terms:
+        term[0].weights = array('f', [1.0] * len(term[0].ids))
+        term[0].max_weight = 1.0
+    terms = [(posting, 1.0) for posting, _ in terms]
+
+    index = empty_index()
+    forward = index.top_k(terms, 10)
+    forward_scored = index.last_scored
+    backward = index.top_k(terms[::-1], 10)
+
+    assert [score for score, _ in forward] == [score for score, _ in backward]
+    assert index.last_scored == forward_scored
+
+def test_top_k_on_catalog(session):
+    index = TagIndex.from_session(session)
+    terms = [
+        (index.postings[key], weight)
+        for key, weight in ((('artist', 'tag0'), 1.0), (('recording', 'tag1'), 2.0))
+        if key in index.postings
+    ]
+
+    expected = brute_force(terms)[:20]
+    result = index.top_k(terms, 20)
+
+    assert [score for score, _ in result] == pytest.approx(
+        [score for score, _ in expected]
+    )
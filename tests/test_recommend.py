@@ -0,0 +1,284 @@
+import random
+import uuid
+from collections import defaultdict
+
+import musicbrainzngs
+import pytest
+from sqlalchemy import select, func, Float, Date
+
+from special_song_search.database import init_db, fill_artists_and_recordings
+from special_song_search.features import rebuild_recording_features
+from special_song_search.models import (
+    artist_recording_association,
+    ArtistTag,
+    Recording, RecordingTag,
+    RecordingFeature
+)
+from special_song_search.recommend import (
+    recommend,
+    recommend_many,
+    _recommend_statement
+)
+from special_song_search.shard import ShardedRecommender
+from special_song_search.snapshot import export_snapshot
+
+from conftest import TAGS
+
+
+LENGTHS = [
+    {'recording_length_condition': 'range', 'range': [0, None]},
+    {'recording_length_condition': 'range', 'range': [120, 400]},
+    {'recording_length_condition': 'center', 'center': 200, 'points_per_second': 0.01},
+]
+DATES = [
+    {'recording_date_condition': 'range', 'range': [1900, None]},
+    {'recording_date_condition': 'range', 'range': [1970, 2000]},
+    {'recording_date_condition': 'center', 'center': 1990, 'points_per_year': 0.05},
+]
+# Both tag types weighted, so every path has the same candidates
+BOTH_TYPES = [(1, 1), (2, 3), (3, 2), (4, 5)]
+
+
+def reference_rows(session, artist_tags, recording_tags, weights,
+                   recording_length, recording_date):
+    """
+    (recording mbid, artist mbid, score) of every joined row, scored with
+    literal tag expressions independently of the statements under test
+    """
+    artist_score = 0.0
+    for tag, tag_weight in artist_tags.items():
+        artist_score += (ArtistTag.tag == tag) * tag_weight
+    recording_score = 0.0
+    for tag, tag_weight in recording_tags.items():
+        recording_score += (RecordingTag.tag == tag) * tag_weight
+    score = (
+        func.cast(0, Float)
+        + artist_score * weights['artist_tags']
+        + recording_score * weights['recording_tags']
+    )
+
+    year = func.cast(Recording.date, Date)
+    seconds = Recording.length / 1_000
+    if recording_length['recording_length_condition'] == 'center':
+        score -= (
+            func.abs(seconds - recording_length['center'])
+            * recording_length['points_per_second']
+        )
+    if recording_date['recording_date_condition'] == 'center':
+        score -= func.abs(year - recording_date['center']) * recording_date['points_per_year']
+
+    statement = (
+        select(Recording.mbid, artist_recording_association.c.artist_mbid, score)
+        .join(artist_recording_association,
+            Recording.mbid == artist_recording_association.c.recording_mbid
+            )
+        .join(ArtistTag, artist_recording_association.c.artist_mbid == ArtistTag.artist_mbid)
+        .join(RecordingTag, RecordingTag.recording_mbid == Recording.mbid)
+    )
+    if recording_length['recording_length_condition'] == 'range':
+        low, high = recording_length['range']
+        statement = statement.where(low <= seconds)
+        if high is not None:
+            statement = statement.where(seconds <= high)
+    if recording_date['recording_date_condition'] == 'range':
+        low, high = recording_date['range']
+        statement = statement.where(low <= year)
+        if high is not None:
+            statement = statement.where(year <= high)
+
+    return session.execute(statement).fetchall()
+
+def reference_scores(rows, limit, unique_recordings=False, max_per_artist=None):
+    """ Scores of the top limit rows, best first """
+    if unique_recordings or max_per_artist is not None:
+        best = dict()
+        for recording_mbid, artist_mbid, score in rows:
+            if recording_mbid not in best or score > best[recording_mbid][1]:
+                best[recording_mbid] = (artist_mbid, score)
+        if max_per_artist is not None:
+            by_artist = defaultdict(list)
+            for artist_mbid, score in best.values():
+                by_artist[artist_mbid].append(score)
+            scores = [
+                score
+                for artist_scores in by_artist.values()
+                for score in sorted(artist_scores, reverse=True)[:max_per_artist]
+            ]
+        else:
+            scores = [score for _, score in best.values()]
+    else:
+        scores = [score for _, _, score in rows]
+    return sorted(scores, reverse=True)[:limit]
+
+def random_query(rng, n_artist_tags, n_recording_tags):
+    return {
+        'artist_tags': {tag: rng.randint(1, 5) for tag in rng.sample(TAGS, n_artist_tags)},
+        'recording_tags': {tag: rng.randint(1, 5) for tag in rng.sample(TAGS, n_recording_tags)},
+        'weights': {'artist_tags': rng.choice([0.5, 1.]), 'recording_tags': rng.choice([1., 2.])},
+        'recording_length': rng.choice(LENGTHS),
+        'recording_date': rng.choice(DATES),
+    }
+
+
+def test_recommend_many_matches_reference(session):
+    rng = random.Random('many')
+    queries = [
+        random_query(rng, n_artist_tags, n_recording_tags)
+        for n_artist_tags, n_recording_tags in BOTH_TYPES * 2
+    ]
+    for query in queries:
+        query['limit'] = rng.choice([5, 20])
+
+    results = recommend_many(
+        session, [{**query, 'randomness': 0.} for query in queries]
+    )
+
+    for query, recommendations in zip(queries, results):
+        query = dict(query)
+        limit = query.pop('limit')
+        expected = reference_scores(
+            reference_rows(session, **query), limit, unique_recordings=True
+        )
+        assert [rec['score'] for rec in recommendations] == pytest.approx(expected)
+
+def test_sharded_matches_reference(session, tmp_path):
+    rng = random.Random('shard')
+    snapshot_path = export_snapshot(session, str(tmp_path))
+    with ShardedRecommender(snapshot_path, n_shards=3, processes=2) as recommender:
+        for n_artist_tags, n_recording_tags in BOTH_TYPES:
+            query = random_query(rng, n_artist_tags, n_recording_tags)
+            limit = rng.choice([5, 20])
+
+            recommendations = recommender.recommend(
+                seed=0, **query, randomness=0., limit=limit
+            )
+            expected = reference_scores(
+                reference_rows(session, **query), limit, unique_recordings=True
+            )
+
+            assert [rec['score'] for rec in recommendations] == pytest.approx(expected)
+
+@pytest.mark.parametrize('n_artist_tags, n_recording_tags', BOTH_TYPES)
+def test_use_features_matches_reference(session, n_artist_tags, n_recording_tags):
+    rng = random.Random(f'features-{n_artist_tags}-{n_recording_tags}')
+    for _ in range(3):
+        query = random_query(rng, n_artist_tags, n_recording_tags)
+        limit = rng.choice([5, 20])
+
+        recommendations = recommend(
+            session, **query, randomness=0., limit=limit, use_features=True
+        )
+        expected = reference_scores(
+            reference_rows(session, **query), limit, unique_recordings=True
+        )
+
+        assert [rec['score'] for rec in recommendations] == pytest.approx(expected)
+
+def test_incremental_features_match_rebuild(tmp_path, monkeypatch):
+    """ recording_feature after a mocked crawl equals a full rebuild """
+    rng = random.Random('crawl')
+    artist_mbids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(6)]
+    recording_mbids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(30)]
+    # Overlapping slices, so later artists share recordings already stored
+    artist_recordings = {
+        artist: recording_mbids[4 * n:4 * n + 10]
+        for n, artist in enumerate(artist_mbids)
+    }
+
+    def tag_list(names):
+        return [{'name': name, 'count': str(rng.randint(0, 9))} for name in names]
+
+    def search_artists(query, country, offset, limit):
+        return {'artist-list': [
+            {
+                'id': artist,
+                'name': artist[:8],
+                'country': country,
+                # A second country's crawl adds tags to the same artists
+                'tag-list': tag_list(rng.sample(TAGS, 3) + [country])
+            }
+            for artist in artist_mbids[offset:offset + limit]
+        ]}
+
+    def browse_recordings(artist, includes, offset, limit):
+        return {'recording-list': [
+            {'id': recording, 'title': recording[:8]}
+            for recording in artist_recordings[artist][offset:offset + limit]
+        ]}
+
+    def get_recording_by_id(id, includes, release_type, release_status):
+        return {'recording': {
+            'id': id,
+            'title': id[:8],
+            'length': '200000',
+            'tag-list': tag_list(rng.sample(TAGS, 2))
+        }}
+
+    monkeypatch.setattr(musicbrainzngs, 'search_artists', search_artists)
+    monkeypatch.setattr(musicbrainzngs, 'browse_recordings', browse_recordings)
+    monkeypatch.setattr(musicbrainzngs, 'get_recording_by_id', get_recording_by_id)
+
+    features = select(
+        RecordingFeature.recording_mbid,
+        RecordingFeature.source,
+        RecordingFeature.tag,
+        RecordingFeature.weight
+    )
+    _, Session = init_db(f"sqlite:///{tmp_path / 'crawl.db'}")
+    with Session() as session:
+        # New artists, then artists sharing stored recordings, then new
+        # tags for stored artists; each checked against a rebuild
+        for country_code, fill_recordings in (
+                ('US', True), ('US', True), ('GB', False)
+            ):
+            fill_artists_and_recordings(
+                session, country_code, 3, 10, fill_recordings=fill_recordings
+            )
+            incremental = sorted(session.execute(features).fetchall())
+            rebuild_recording_features(session)
+            rebuilt = sorted(session.execute(features).fetchall())
+
+            assert len(incremental) > 0
+            assert incremental == rebuilt
+
+# Tag counts covering 1, 2, 4 and 8 slots, with and without padding
+@pytest.mark.parametrize('n_artist_tags, n_recording_tags', [
+    (1, 1), (2, 3), (3, 2), (4, 5), (5, 0), (0, 6),
+])
+@pytest.mark.parametrize('diversity', [
+    {}, {'unique_recordings': True}, {'max_per_artist': 1}, {'max_per_artist': 3},
+])
+def test_cached_statement_matches_literal_expressions(
+        session, n_artist_tags, n_recording_tags, diversity):
+    rng = random.Random(f'{n_artist_tags}-{n_recording_tags}-{diversity}')
+    for _ in range(3):
+        query = random_query(rng, n_artist_tags, n_recording_tags)
+        limit = rng.choice([5, 20, 100])
+
+        recommendations = recommend(
+            session, **query, randomness=0., limit=limit, **diversity
+        )
+        expected = reference_scores(
+            reference_rows(session, **query), limit, **diversity
+        )
+
+        assert [rec['score'] for rec in recommendations] == pytest.approx(expected)
+
+        if diversity:
+            mbids = [rec['recording']['mbid'] for rec in recommendations]
+            assert len(mbids) == len(set(mbids))
+        if 'max_per_artist' in diversity:
+            artists = defaultdict(int)
+            for rec in recommendations:
+                artists[rec['artists'][0]['mbid']] += 1
+            assert max(artists.values(), default=0) <= diversity['max_per_artist']
+
+def test_statement_shared_across_tag_values(session):
+    rng = random.Random(1)
+    _recommend_statement.cache_clear()
+    for n_tags in (3, 4, 3, 4, 3):
+        query = random_query(rng, n_tags, n_tags)
+        query['recording_length'], query['recording_date'] = LENGTHS[0], DATES[2]
+        recommend(session, **query, randomness=0., limit=5)
+    # Same shape each time (3 and 4 tags use 4 slots), whatever the tags
+    assert _recommend_statement.cache_info().currsize == 1